@@ -1,17 +1,24 @@
 import os
 import sys
+import errno
 import asyncio
+import logging
 import aiohttp
 import aiomysql
+import random
 import shutil
 import time
-from typing import Dict, Any, Optional
+from collections import OrderedDict
+from typing import Dict, Any, List, Optional, Set, Tuple
 from pathlib import Path
 from datetime import datetime
-from config import settings
+from email.utils import parsedate_to_datetime
+from config import get_settings
 from logger import Logger
 import urllib.parse
 
+settings = get_settings()
+
 # 初始化日志
 logger = Logger("downloader").logger
 
@@ -23,21 +30,54 @@ MYSQL_CONFIG = {
     'password': settings.MYSQL_ROOT_PASSWORD,  # 使用root密码
     'db': settings.MYSQL_DATABASE,
     'charset': 'utf8mb4',
-    'autocommit': True  # 启用自动提交
+    'autocommit': True,  # 启用自动提交
+    'minsize': 2,  # 连接池最小连接数
+    'maxsize': settings.DOWNLOAD_CONCURRENCY + 2,  # 连接池最大连接数
+    'pool_recycle': 300  # 连接回收时间(秒)，避免使用被服务端断开的连接
 }
 
 # 下载配置
-BATCH_SIZE = int(settings.BATCH_SIZE)  # 每次处理的文件数量
-SLEEP_TIME = int(settings.SLEEP_TIME)  # 每次循环后休眠时间(秒)
+BATCH_SIZE = settings.BATCH_SIZE  # 每次处理的文件数量
+DOWNLOAD_CONCURRENCY = settings.DOWNLOAD_CONCURRENCY  # 同时下载的文件数量
+SLEEP_TIME = settings.SLEEP_TIME  # 每次循环后休眠时间(秒)
 DELETE_AFTER_DOWNLOAD = settings.DELETE_AFTER_DOWNLOAD  # 下载成功后是否删除文件
-MIN_DISK_SPACE = int(settings.DISK_FREE)  # 最小磁盘空间要求(10GB)
+MIN_DISK_SPACE = settings.DISK_FREE  # 最小磁盘空间要求(10GB)
 REMOVE_PREFIX = settings.GET_ROOT_DIR  # 需要移除的路径前缀
+WRITE_BUFFER_SIZE = 4 << 20  # 写盘前合并的缓冲区大小(4MB)
+RAW_URL_CACHE_SIZE = 1024  # 文件流地址缓存条目上限
+DISK_CHECK_INTERVAL = 30  # 磁盘剩余空间缓存有效期(秒)
+GB = 1024 ** 3
 MAX_DB_RETRIES = 3  # 数据库操作最大重试次数
-DB_RETRY_DELAY = 5  # 数据库重试延迟（秒）
+CLAIM_TIMEOUT = 24 * 60 * 60  # 文件处于下载中超过该时间(秒)视为遗留，重新放回队列
+STALE_RELEASE_INTERVAL = 10 * 60  # 检查遗留下载中记录的间隔(秒)
+BACKOFF_BASE = 1.5  # 重试退避基础时间(秒)，按2的指数增长
+MAX_BACKOFF = 60  # 重试退避时间上限(秒)
+MAX_RATE_LIMIT_RETRIES = 3  # 接口被限流(429)时的最大重试次数
+
+# HTTP连接池配置
+HTTP_POOL_LIMIT = 100  # 连接池总连接数上限
+HTTP_POOL_LIMIT_PER_HOST = 20  # 单个主机的连接数上限
+HTTP_KEEPALIVE_TIMEOUT = 60  # keep-alive连接保持时间(秒)
+HTTP_DNS_CACHE_TTL = 600  # DNS缓存时间(秒)
+
+# 文件处理状态
+FILE_STATUS_PENDING = 0  # 未处理
+FILE_STATUS_DONE = 1  # 已下载
+FILE_STATUS_IN_PROGRESS = 3  # 下载中（已被某个进程领取）
+FILE_STATUS_FAILED = 2  # 下载失败
 
 # 文件保存配置
-SAVE_ROOT_DIR = "/data"  # 文件保存根目录
-PRESERVE_PATH_STRUCTURE = True  # 是否保留原始路径结构
+SAVE_ROOT_DIR = settings.SAVE_ROOT_DIR  # 文件保存根目录
+PRESERVE_PATH_STRUCTURE = settings.PRESERVE_PATH_STRUCTURE  # 是否保留原始路径结构
+
+# 路径清理：移除引号，空格替换为下划线
+_PATH_TRANSLATION = str.maketrans({"'": None, '"': None, ' ': '_'})
+# 文件名清理：移除文件系统不允许的字符
+_FILENAME_TRANSLATION = str.maketrans(dict.fromkeys('<>:"/\\|?*'))
+
+# 最近一次查询到的磁盘剩余空间：(查询时间, 剩余字节数)
+# 下载路径都位于SAVE_ROOT_DIR下，共用同一份缓存
+_disk_free_cache: Optional[Tuple[float, int]] = None
 
 class DownloadError(Exception):
     """下载错误的自定义异常"""
@@ -47,8 +87,39 @@ class DatabaseError(Exception):
     """数据库错误的自定义异常"""
     pass
 
-def check_disk_space(path: str, required_space: int = MIN_DISK_SPACE) -> bool:
-    """检查磁盘空间是否足够"""
+def backoff_delay(attempt: int, retry_after: Optional[float] = None) -> float:
+    """计算带随机抖动的指数退避时间，服务端给出Retry-After时不早于该时间"""
+    delay = min(MAX_BACKOFF, BACKOFF_BASE * (2 ** attempt)) + random.random()
+    if retry_after is not None:
+        delay = max(delay, retry_after)
+    return delay
+
+def parse_retry_after(value: Optional[str]) -> Optional[float]:
+    """解析Retry-After响应头，支持秒数和HTTP日期两种格式"""
+    if not value:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        retry_at = parsedate_to_datetime(value)
+        return max(0.0, (retry_at - datetime.now(retry_at.tzinfo)).total_seconds())
+    except (TypeError, ValueError):
+        return None
+
+def check_disk_space(path: str, required_space: int = MIN_DISK_SPACE, use_cache: bool = False) -> bool:
+    """
+    检查磁盘空间是否足够
+    use_cache: 在DISK_CHECK_INTERVAL内复用上次查询到的剩余空间，并扣除期间已放行的文件大小
+    """
+    global _disk_free_cache
+    if use_cache and _disk_free_cache is not None:
+        checked_at, free = _disk_free_cache
+        if time.monotonic() - checked_at < DISK_CHECK_INTERVAL and free > required_space:
+            _disk_free_cache = (checked_at, free - required_space)
+            return True
+
     try:
         # 首先检查路径是否存在
         if not os.path.exists(path):
@@ -62,36 +133,22 @@ def check_disk_space(path: str, required_space: int = MIN_DISK_SPACE) -> bool:
 
         # 获取路径的绝对路径
         abs_path = os.path.abspath(path)
-        logger.info("检查路径", extra={"path": abs_path})
 
         # 获取磁盘使用情况
         total, used, free = shutil.disk_usage(abs_path)
+        _disk_free_cache = (time.monotonic(), free)
         
-        # 转换为GB进行记录
-        total_gb = total / (1024 ** 3)
-        used_gb = used / (1024 ** 3)
-        free_gb = free / (1024 ** 3)
-        required_gb = required_space / (1024 ** 3)
-        
-        logger.info(
-            "磁盘空间信息", 
-            extra={
-                "path": abs_path,
-                "total_gb": f"{total_gb:.2f}GB",
-                "used_gb": f"{used_gb:.2f}GB",
-                "free_gb": f"{free_gb:.2f}GB",
-                "required_gb": f"{required_gb:.2f}GB"
-            }
-        )
+        # 转换为GB进行记录，日志级别未开启时跳过格式化
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug(
+                "磁盘空间信息 - 路径: %s, 总空间: %.2fGB, 已用: %.2fGB, 剩余: %.2fGB, 需要: %.2fGB",
+                abs_path, total / GB, used / GB, free / GB, required_space / GB
+            )
 
         if free <= required_space:
             logger.warning(
-                "磁盘空间不足", 
-                extra={
-                    "path": abs_path,
-                    "free_gb": f"{free_gb:.2f}GB",
-                    "required_gb": f"{required_gb:.2f}GB"
-                }
+                "磁盘空间不足 - 路径: %s, 剩余: %.2fGB, 需要: %.2fGB",
+                abs_path, free / GB, required_space / GB
             )
             return False
 
@@ -124,6 +181,51 @@ def check_disk_space(path: str, required_space: int = MIN_DISK_SPACE) -> bool:
         })
         return False
 
+def _stat_size(path: str) -> Optional[int]:
+    """获取文件大小，文件不存在时返回None"""
+    try:
+        return os.stat(path).st_size
+    except FileNotFoundError:
+        return None
+
+def _open_download_file(path: str, offset: int, total_size: int) -> int:
+    """
+    打开临时文件并预分配offset之后的空间，返回文件描述符
+    磁盘空间不足以预分配时抛出DownloadError
+    """
+    flags = os.O_WRONLY | os.O_CREAT
+    if offset == 0:
+        flags |= os.O_TRUNC
+    fd = os.open(path, flags, 0o644)
+    try:
+        if total_size > offset and hasattr(os, 'posix_fallocate'):
+            try:
+                os.posix_fallocate(fd, offset, total_size - offset)
+            except OSError as e:
+                if e.errno == errno.ENOSPC:
+                    raise DownloadError(f"磁盘空间不足，无法预分配{total_size - offset}字节") from e
+                # 文件系统不支持预分配时跳过
+                if e.errno not in (errno.EOPNOTSUPP, errno.EINVAL):
+                    raise
+    except Exception:
+        os.close(fd)
+        raise
+    return fd
+
+def _write_all(fd: int, data: bytearray, offset: int) -> None:
+    """将缓冲区完整写入文件描述符的offset位置"""
+    with memoryview(data) as view:
+        written = 0
+        while written < len(view):
+            written += os.pwrite(fd, view[written:], offset + written)
+
+def _close_download_file(fd: int, size: int) -> None:
+    """按实际写入大小截断并关闭临时文件"""
+    try:
+        os.ftruncate(fd, size)
+    finally:
+        os.close(fd)
+
 def ensure_directory(path: str) -> bool:
     """确保目录存在，如果不存在则创建"""
     try:
@@ -136,19 +238,16 @@ def ensure_directory(path: str) -> bool:
 class Database:
     def __init__(self):
         self.pool = None
+        # 串行化连接池重建，避免并发重试时各自创建连接池
+        self._pool_lock = asyncio.Lock()
 
     async def ensure_connected(self):
-        """确保数据库连接可用"""
-        if self.pool is None or self.pool._closed:
-            await self.init_db()
-        try:
-            async with self.pool.acquire() as conn:
-                async with conn.cursor() as cur:
-                    await cur.execute("SELECT 1")
-        except Exception as e:
-            logger.warning("数据库连接检查失败，尝试重新连接", extra={"error": str(e)})
-            await self.close()
-            await self.init_db()
+        """确保数据库连接池可用，只有连接池不存在或已关闭时才重建"""
+        if self.pool is not None and not self.pool._closed:
+            return
+        async with self._pool_lock:
+            if self.pool is None or self.pool._closed:
+                await self.init_db()
 
     async def init_db(self):
         """初始化数据库连接池"""
@@ -157,10 +256,6 @@ class Database:
         
         while retries < MAX_DB_RETRIES:
             try:
-                if self.pool:
-                    self.pool.close()
-                    await self.pool.wait_closed()
-                
                 self.pool = await aiomysql.create_pool(**MYSQL_CONFIG)
                 logger.info("数据库连接池初始化成功")
                 return
@@ -172,7 +267,7 @@ class Database:
                     "error": str(e)
                 })
                 if retries < MAX_DB_RETRIES:
-                    await asyncio.sleep(DB_RETRY_DELAY * retries)
+                    await asyncio.sleep(backoff_delay(retries))
         
         raise DatabaseError(f"数据库连接失败，已达到最大重试次数: {last_error}")
 
@@ -184,7 +279,10 @@ class Database:
             self.pool = None
 
     async def execute_with_retry(self, operation):
-        """使用重试机制执行数据库操作"""
+        """
+        使用重试机制执行数据库操作
+        失败时只重试操作本身，失效的连接由aiomysql在归还时丢弃，不重建共享的连接池
+        """
         retries = 0
         last_error = None
         
@@ -200,43 +298,106 @@ class Database:
                     "error": str(e)
                 })
                 if retries < MAX_DB_RETRIES:
-                    await asyncio.sleep(DB_RETRY_DELAY * retries)
+                    await asyncio.sleep(backoff_delay(retries))
                     continue
                 raise DatabaseError(f"数据库操作失败，已达到最大重试次数: {last_error}")
 
-    async def get_unprocessed_files(self, limit: int = 10):
-        """获取未处理的文件记录"""
+    async def ensure_indexes(self):
+        """确保存在(is_processed, id)索引，避免按状态和ID分页查询时全表扫描"""
         async def _operation():
             async with self.pool.acquire() as conn:
-                async with conn.cursor(aiomysql.DictCursor) as cur:
+                async with conn.cursor() as cur:
+                    # 只认前两列恰好为(is_processed, id)的索引，(is_processed, dir_path_l3)等不满足键集分页
                     await cur.execute('''
-                        SELECT id, path, sign, size 
-                        FROM files 
-                        WHERE is_processed = 0 
-                        LIMIT %s
-                    ''', (limit,))
-                    return await cur.fetchall()
-        return await self.execute_with_retry(_operation)
+                        SELECT INDEX_NAME 
+                        FROM information_schema.STATISTICS 
+                        WHERE TABLE_SCHEMA = DATABASE() AND TABLE_NAME = 'files' 
+                        GROUP BY INDEX_NAME 
+                        HAVING SUM(SEQ_IN_INDEX = 1 AND COLUMN_NAME = 'is_processed') = 1 
+                        AND SUM(SEQ_IN_INDEX = 2 AND COLUMN_NAME = 'id') = 1
+                    ''')
+                    if await cur.fetchone():
+                        return
+                    logger.info("创建索引", extra={"index": "idx_files_unprocessed"})
+                    await cur.execute('''
+                        CREATE INDEX idx_files_unprocessed ON files (is_processed, id) 
+                        ALGORITHM=INPLACE LOCK=NONE
+                    ''')
+        await self.execute_with_retry(_operation)
 
-    async def update_file_status(self, file_id: int, status: int, error_msg: str = None):
-        """更新文件处理状态"""
+    async def get_unprocessed_files(self, limit: int = 10, after_id: int = 0):
+        """
+        领取未处理的文件记录
+        在事务中以FOR UPDATE SKIP LOCKED锁定并标记为下载中，多个进程可安全地共享同一队列
+        after_id: 只领取ID大于该值的记录（键集分页），避免重复扫描已领取的区间
+        """
         async def _operation():
             async with self.pool.acquire() as conn:
-                async with conn.cursor() as cur:
-                    if error_msg:
-                        await cur.execute('''
-                            UPDATE files 
-                            SET is_processed = %s, error_message = %s, 
-                                updated_at = CURRENT_TIMESTAMP 
-                            WHERE id = %s
-                        ''', (status, error_msg, file_id))
-                    else:
+                await conn.begin()
+                try:
+                    async with conn.cursor(aiomysql.DictCursor) as cur:
                         await cur.execute('''
-                            UPDATE files 
-                            SET is_processed = %s, updated_at = CURRENT_TIMESTAMP 
-                            WHERE id = %s
-                        ''', (status, file_id))
+                            SELECT id, path, sign, size 
+                            FROM files 
+                            WHERE is_processed = %s AND id > %s 
+                            ORDER BY id 
+                            LIMIT %s 
+                            FOR UPDATE SKIP LOCKED
+                        ''', (FILE_STATUS_PENDING, after_id, limit))
+                        files = await cur.fetchall()
+                        if files:
+                            id_placeholders = ', '.join(['%s'] * len(files))
+                            await cur.execute(f'''
+                                UPDATE files 
+                                SET is_processed = %s, updated_at = CURRENT_TIMESTAMP 
+                                WHERE id IN ({id_placeholders})
+                            ''', (FILE_STATUS_IN_PROGRESS, *(file['id'] for file in files)))
                     await conn.commit()
+                    return files
+                except Exception:
+                    await conn.rollback()
+                    raise
+        return await self.execute_with_retry(_operation)
+
+    async def release_stale_files(self, timeout: int = CLAIM_TIMEOUT):
+        """将超时仍处于下载中的文件重置为未处理（进程异常退出时遗留的记录）"""
+        async def _operation():
+            async with self.pool.acquire() as conn:
+                async with conn.cursor() as cur:
+                    await cur.execute('''
+                        UPDATE files 
+                        SET is_processed = %s, updated_at = CURRENT_TIMESTAMP 
+                        WHERE is_processed = %s 
+                        AND updated_at < NOW() - INTERVAL %s SECOND
+                    ''', (FILE_STATUS_PENDING, FILE_STATUS_IN_PROGRESS, timeout))
+                    return cur.rowcount
+        return await self.execute_with_retry(_operation)
+
+    async def update_file_status_bulk(self, rows: List[Tuple[int, int, Optional[str]]]):
+        """
+        批量更新文件处理状态，一条UPDATE语句完成整批更新
+        rows: [(文件ID, 状态, 错误信息)]，错误信息为空时保留原值
+        """
+        if not rows:
+            return
+
+        status_cases = ' '.join(['WHEN %s THEN %s'] * len(rows))
+        error_cases = ' '.join(['WHEN %s THEN COALESCE(%s, error_message)'] * len(rows))
+        id_placeholders = ', '.join(['%s'] * len(rows))
+        params = [value for file_id, status, _ in rows for value in (file_id, status)]
+        params += [value for file_id, _, error_msg in rows for value in (file_id, error_msg or None)]
+        params += [file_id for file_id, _, _ in rows]
+
+        async def _operation():
+            async with self.pool.acquire() as conn:
+                async with conn.cursor() as cur:
+                    await cur.execute(f'''
+                        UPDATE files 
+                        SET is_processed = CASE id {status_cases} END, 
+                            error_message = CASE id {error_cases} END, 
+                            updated_at = CURRENT_TIMESTAMP 
+                        WHERE id IN ({id_placeholders})
+                    ''', params)
         await self.execute_with_retry(_operation)
 
 class Downloader:
@@ -248,10 +409,32 @@ class Downloader:
             "Content-Type": "application/json",
             "User-Agent": "pan.baidu.com"
         }
+        # 日志中输出的请求头（不含鉴权信息）
+        self._headers_info_for_log = {k: v for k, v in self.headers.items() if k != "Authorization"}
+        # 文件流地址缓存，键为(文件路径, 文件签名)
+        self._raw_url_cache: OrderedDict[Tuple[str, str], str] = OrderedDict()
         # 确保保存根目录存在
         if not ensure_directory(SAVE_ROOT_DIR):
             raise DownloadError(f"无法创建保存根目录: {SAVE_ROOT_DIR}")
 
+    async def _get_cached_raw_url(self, file_path: str, sign: str) -> Optional[str]:
+        """
+        获取文件的流地址，优先使用缓存
+        返回: 成功返回raw_url，失败返回None
+        """
+        cache_key = (file_path, sign)
+        raw_url = self._raw_url_cache.get(cache_key)
+        if raw_url is not None:
+            self._raw_url_cache.move_to_end(cache_key)
+            return raw_url
+
+        raw_url = await self._get_raw_url(file_path)
+        if raw_url:
+            self._raw_url_cache[cache_key] = raw_url
+            if len(self._raw_url_cache) > RAW_URL_CACHE_SIZE:
+                self._raw_url_cache.popitem(last=False)
+        return raw_url
+
     async def _get_raw_url(self, file_path: str) -> Optional[str]:
         """
         获取文件的流地址
@@ -264,82 +447,85 @@ class Downloader:
                 "path": file_path
             }
             
-            headers_info = {k: v for k, v in self.headers.items() if k != "Authorization"}
-            logger.info(f"开始请求文件流地址 - URL: {url}, 路径: {file_path}, 请求头: {headers_info}")
+            logger.info("开始请求文件流地址 - URL: %s, 路径: %s, 请求头: %s", url, file_path, self._headers_info_for_log)
             
-            async with self.session.post(url, json=payload, headers=self.headers) as response:
-                response_text = await response.text()
-                if response.status != 200:
-                    logger.error(f"获取文件信息失败 - 路径: {file_path}, 状态码: {response.status}, URL: {url}, 响应: {response_text}")
-                    return None
-                
-                try:
-                    data = await response.json()
-                except Exception as e:
-                    logger.error(f"解析响应JSON失败 - 路径: {file_path}, 错误: {str(e)}, 响应: {response_text}")
-                    return None
-                
-                if data.get("code") != 200:
-                    logger.error(f"获取文件信息失败 - 路径: {file_path}, 消息: {data.get('message')}, 代码: {data.get('code')}, 响应: {data}")
-                    return None
-                
-                raw_url = data.get("data", {}).get("raw_url")
-                if not raw_url:
-                    logger.error(f"文件流地址为空 - 路径: {file_path}, 响应: {data}")
-                    return None
-                
-                logger.info(f"成功获取文件流地址 - 路径: {file_path}, 状态码: {response.status}")
-                return raw_url
+            for attempt in range(MAX_RATE_LIMIT_RETRIES):
+                async with self.session.post(url, json=payload, headers=self.headers) as response:
+                    if response.status != 429:
+                        return await self._parse_raw_url_response(response, file_path, url)
+                    delay = backoff_delay(attempt + 1, parse_retry_after(response.headers.get("Retry-After")))
+
+                # 被限流时按退避时间等待后重试
+                logger.warning("获取文件流地址被限流，%.1f秒后重试 - 路径: %s", delay, file_path)
+                await asyncio.sleep(delay)
+
+            logger.error("获取文件流地址被限流，已达到最大重试次数 - 路径: %s", file_path)
+            return None
                 
         except Exception as e:
-            error_info = {
-                "path": file_path,
-                "error": str(e),
-                "error_type": type(e).__name__,
-                "url": url,
-                "headers": {k: v for k, v in self.headers.items() if k != "Authorization"}
-            }
-            logger.error(f"获取文件流地址出错 - {error_info}")
+            logger.error(
+                "获取文件流地址出错 - 路径: %s, 错误: %s, 错误类型: %s, URL: %s, 请求头: %s",
+                file_path, e, type(e).__name__, url, self._headers_info_for_log
+            )
             return None
 
-    def _get_download_path(self, file_path: str) -> tuple[str, str, str]:
+    async def _parse_raw_url_response(self, response: aiohttp.ClientResponse, file_path: str, url: str) -> Optional[str]:
+        """
+        解析文件详情接口的响应
+        返回: 成功返回raw_url，失败返回None
+        """
+        response_text = await response.text()
+        if response.status != 200:
+            logger.error("获取文件信息失败 - 路径: %s, 状态码: %s, URL: %s, 响应: %s", file_path, response.status, url, response_text)
+            return None
+        
+        try:
+            data = await response.json()
+        except Exception as e:
+            logger.error("解析响应JSON失败 - 路径: %s, 错误: %s, 响应: %s", file_path, e, response_text)
+            return None
+        
+        if data.get("code") != 200:
+            logger.error("获取文件信息失败 - 路径: %s, 消息: %s, 代码: %s, 响应: %s", file_path, data.get('message'), data.get('code'), data)
+            return None
+        
+        raw_url = data.get("data", {}).get("raw_url")
+        if not raw_url:
+            logger.error("文件流地址为空 - 路径: %s, 响应: %s", file_path, data)
+            return None
+        
+        logger.info("成功获取文件流地址 - 路径: %s, 状态码: %s", file_path, response.status)
+        return raw_url
+
+    def _get_download_path(self, file_path: str) -> tuple[Path, Path, Path]:
         """
         处理下载路径和文件名
-        返回: (目标目录, 临时文件名, 最终文件名)
+        返回: (目标目录, 临时文件路径, 最终文件路径)
         """
         # 移除前缀
         if file_path.startswith(REMOVE_PREFIX):
             file_path = file_path[len(REMOVE_PREFIX):]
 
-        # 处理文件路径中的特殊字符
-        # 1. 移除路径中的引号（单引号和双引号）
-        file_path = file_path.replace("'", "").replace('"', "")
-        # 2. 处理文件路径，保留原始文件名
-        file_path = file_path.lstrip('/')
+        # 处理文件路径中的特殊字符：移除引号（单引号和双引号），空格替换为下划线
+        file_path = file_path.translate(_PATH_TRANSLATION).lstrip('/')
         
         # 根据配置决定是否保留原始路径结构
         if PRESERVE_PATH_STRUCTURE:
             # 保留原始路径结构，但使用保存根目录
-            # 替换路径中的空格
-            clean_path = file_path.replace(' ', '_')
-            full_path = os.path.join(SAVE_ROOT_DIR, clean_path)
+            full_path = os.path.join(SAVE_ROOT_DIR, file_path)
         else:
             # 不保留路径结构，直接保存到根目录
-            final_filename = os.path.basename(file_path)
-            # 替换文件名中的空格
-            final_filename = final_filename.replace(' ', '_')
-            full_path = os.path.join(SAVE_ROOT_DIR, final_filename)
+            full_path = os.path.join(SAVE_ROOT_DIR, os.path.basename(file_path))
         
-        target_dir = os.path.dirname(full_path)
-        final_filename = os.path.basename(full_path)
+        target_dir, final_filename = os.path.split(full_path)
         
         # 处理文件名中的特殊字符
-        # 1. 移除文件名开头和结尾的空格
-        final_filename = final_filename.strip()
-        # 2. 替换文件名中的所有空格为下划线
-        final_filename = final_filename.replace(' ', '_')
-        # 3. 移除或替换可能导致问题的特殊字符
-        final_filename = ''.join(c for c in final_filename if c.isprintable() and c not in '<>:"/\\|?*')
+        # 1. 移除文件名开头和结尾的空白字符
+        # 2. 移除可能导致问题的特殊字符
+        final_filename = final_filename.strip().translate(_FILENAME_TRANSLATION)
+        # 3. 移除不可打印字符（常见情况下整串可打印，无需逐字符处理）
+        if not final_filename.isprintable():
+            final_filename = ''.join(c for c in final_filename if c.isprintable())
         
         # 如果文件名为空，使用时间戳作为文件名
         if not final_filename:
@@ -352,196 +538,322 @@ class Downloader:
             raise DownloadError(f"无法创建目标目录: {target_dir}")
             
         # 创建临时文件名（使用原始文件名的 base 部分）
-        base_name = os.path.splitext(final_filename)[0]
-        file_ext = os.path.splitext(final_filename)[1]
+        base_name, file_ext = os.path.splitext(final_filename)
         temp_filename = f"{base_name}.downloading{file_ext}"
 
-        return target_dir, temp_filename, final_filename
-
-    async def _get_file_size(self, url: str) -> Optional[int]:
-        """获取远程文件大小"""
-        try:
-            async with self.session.head(url) as response:
-                if response.status == 200:
-                    return int(response.headers.get('Content-Length', 0))
-        except Exception as e:
-            logger.error("获取文件大小失败", extra={"error": str(e)})
-        return None
+        target_dir = Path(target_dir)
+        return target_dir, target_dir / temp_filename, target_dir / final_filename
 
     async def download_file(self, file_path: str, sign: str, file_size: int) -> bool:
         """
         下载文件
         返回: 是否下载成功
         """
-        target_dir, temp_filename, final_filename = self._get_download_path(file_path)
-        
-        # 创建目标目录
-        os.makedirs(target_dir, exist_ok=True)
-        
-        temp_file_path = os.path.join(target_dir, temp_filename)
-        final_file_path = os.path.join(target_dir, final_filename)
-        
-        # 检查文件是否已存在
-        if os.path.exists(final_file_path):
-            logger.info("文件已存在", extra={"path": final_file_path})
-            return True
+        if not DELETE_AFTER_DOWNLOAD:
+            target_dir, temp_file_path, final_file_path = self._get_download_path(file_path)
+            
+            # 检查文件是否已存在且大小一致，无需任何网络请求
+            if await asyncio.to_thread(_stat_size, final_file_path) == file_size:
+                logger.info("文件已存在: %s", final_file_path)
+                return True
 
         # 获取文件的流地址
-        download_url = await self._get_raw_url(file_path)
+        download_url = await self._get_cached_raw_url(file_path, sign)
         if not download_url:
             logger.error("获取文件流地址失败，跳过下载", extra={"path": file_path})
             return False
-        
-        # 检查磁盘空间是否足够
-        if not check_disk_space(target_dir, file_size):
-            logger.error("磁盘空间不足", extra={"path": file_path, "size": file_size})
-            return False
 
-        retries = 0
-        while retries < 3:  # 最大重试次数
+        if DELETE_AFTER_DOWNLOAD:
+            # 下载后即删除时不落盘，只拉取数据并按字节数校验，省去写盘、重命名和删除
+            local_size = 0
+            fd = None
+        else:
+            # 检查磁盘空间是否足够
+            if not check_disk_space(target_dir, file_size, use_cache=True):
+                logger.error("磁盘空间不足", extra={"path": file_path, "size": file_size})
+                return False
+
+            # 获取已下载的文件大小，临时文件在整个下载过程中只打开一次并预分配空间
+            local_size = await asyncio.to_thread(_stat_size, temp_file_path) or 0
+            if local_size > file_size:
+                # 临时文件比远端文件还大，无法续传，重新下载
+                local_size = 0
             try:
-                # 获取已下载的文件大小
-                local_size = os.path.getsize(temp_file_path) if os.path.exists(temp_file_path) else 0
-                
-                # 设置断点续传的header
-                headers = {
-                    "User-Agent": "pan.baidu.com"
-                }
-                if local_size > 0:
-                    headers['Range'] = f'bytes={local_size}-'
-
-                async with self.session.get(download_url, headers=headers) as response:
-                    if response.status not in (200, 206):
-                        raise DownloadError(f"下载失败，状态码: {response.status}")
-
-                    # 以追加模式打开文件
-                    mode = 'ab' if local_size > 0 else 'wb'
-                    with open(temp_file_path, mode) as f:
-                        async for chunk in response.content.iter_chunked(8192):
-                            if chunk:
-                                f.write(chunk)
-
-                # 检查下载的文件大小是否正确
-                if os.path.getsize(temp_file_path) != file_size:
-                    raise DownloadError(f"文件大小不匹配，期望：{file_size}，实际：{os.path.getsize(temp_file_path)}")
-
-                # 下载完成后重命名文件
-                os.rename(temp_file_path, final_file_path)
-                logger.info("文件下载完成", extra={"path": final_file_path})
-                
-                # 如果配置了下载后删除，则删除文件
-                if DELETE_AFTER_DOWNLOAD:
-                    try:
-                        os.remove(final_file_path)
-                        logger.info("文件已删除", extra={"path": final_file_path})
-                    except Exception as e:
-                        logger.error("删除文件失败", extra={"path": final_file_path, "error": str(e)})
-                
+                fd = await asyncio.to_thread(_open_download_file, temp_file_path, local_size, file_size)
+            except DownloadError as e:
+                logger.error("预分配文件空间失败", extra={"path": file_path, "error": str(e)})
+                return False
+        written = local_size
+        try:
+            retries = 0
+            while written != file_size and retries < 3:  # 最大重试次数
+                retry_after = None
+                try:
+                    # 流地址失效后重新获取
+                    if not download_url:
+                        download_url = await self._get_cached_raw_url(file_path, sign)
+                        if not download_url:
+                            raise DownloadError("重新获取文件流地址失败")
+
+                    # 设置断点续传的header
+                    headers = {
+                        "User-Agent": "pan.baidu.com"
+                    }
+                    if written > 0:
+                        headers['Range'] = f'bytes={written}-'
+
+                    async with self.session.get(download_url, headers=headers) as response:
+                        if response.status == 429:
+                            # 被限流，按服务端要求的时间等待后重试
+                            retry_after = parse_retry_after(response.headers.get("Retry-After"))
+                        elif 400 <= response.status < 500:
+                            # 流地址可能已过期，清除缓存以便下次重试时重新获取
+                            self._raw_url_cache.pop((file_path, sign), None)
+                            download_url = None
+                        if response.status not in (200, 206):
+                            raise DownloadError(f"下载失败，状态码: {response.status}")
+
+                        if response.status == 200 and written > 0:
+                            # 服务端未按Range返回，从头写入
+                            written = 0
+
+                        if fd is None:
+                            # 不落盘，只统计接收到的字节数
+                            async for chunk, _ in response.content.iter_chunks():
+                                written += len(chunk)
+                                if written > file_size:
+                                    raise DownloadError(f"下载数据超出文件大小，期望：{file_size}")
+                        else:
+                            # 数据块合并到缓冲区后在线程中按偏移批量写入，写盘不阻塞事件循环
+                            buffer = bytearray()
+                            async for chunk, _ in response.content.iter_chunks():
+                                buffer += chunk
+                                if written + len(buffer) > file_size:
+                                    raise DownloadError(f"下载数据超出文件大小，期望：{file_size}")
+                                if len(buffer) >= WRITE_BUFFER_SIZE:
+                                    await asyncio.to_thread(_write_all, fd, buffer, written)
+                                    written += len(buffer)
+                                    buffer.clear()
+                            if buffer:
+                                await asyncio.to_thread(_write_all, fd, buffer, written)
+                                written += len(buffer)
+
+                    # 检查下载的文件大小是否正确（按已写入字节数计算，无需再stat文件）
+                    if written != file_size:
+                        raise DownloadError(f"文件大小不匹配，期望：{file_size}，实际：{written}")
+
+                except Exception as e:
+                    retries += 1
+                    logger.error("下载失败", extra={
+                        "retry": f"{retries}/3",
+                        "path": file_path,
+                        "error": str(e)
+                    })
+                    if retries < 3:
+                        await asyncio.sleep(backoff_delay(retries, retry_after))  # 带抖动的指数退避
+        finally:
+            if fd is not None:
+                # 截掉预分配但未写入的部分，保证断点续传时的本地大小准确
+                await asyncio.to_thread(_close_download_file, fd, written)
+
+        if DELETE_AFTER_DOWNLOAD:
+            if written == file_size:
+                logger.info("文件下载完成（未保存）: %s", file_path)
                 return True
+            return False
 
-            except Exception as e:
-                retries += 1
-                logger.error("下载失败", extra={
-                    "retry": f"{retries}/3",
-                    "path": file_path,
-                    "error": str(e)
-                })
-                await asyncio.sleep(5 * retries)  # 指数退避
-                
-                # 检查临时文件是否完整
-                if os.path.exists(temp_file_path):
-                    if os.path.getsize(temp_file_path) != file_size:
-                        # 文件不完整，下次继续下载
-                        continue
-                    else:
-                        # 文件已完整下载，重命名并返回
-                        os.rename(temp_file_path, final_file_path)
-                        
-                        # 如果配置了下载后删除，则删除文件
-                        if DELETE_AFTER_DOWNLOAD:
-                            try:
-                                os.remove(final_file_path)
-                                logger.info("文件已删除", extra={"path": final_file_path})
-                            except Exception as e:
-                                logger.error("删除文件失败", extra={"path": final_file_path, "error": str(e)})
-                        
-                        return True
+        if written == file_size:
+            # 下载完成后重命名文件
+            await asyncio.to_thread(os.rename, temp_file_path, final_file_path)
+            logger.info("文件下载完成: %s", final_file_path)
+            return True
 
         # 清理垃圾文件
-        if os.path.exists(temp_file_path):
-            try:
-                os.remove(temp_file_path)
-                logger.info("清理临时文件", extra={"path": temp_file_path})
-            except Exception as e:
-                logger.error("清理临时文件失败", extra={"path": temp_file_path, "error": str(e)})
+        try:
+            await asyncio.to_thread(os.remove, temp_file_path)
+            logger.info("清理临时文件", extra={"path": temp_file_path})
+        except FileNotFoundError:
+            pass
+        except Exception as e:
+            logger.error("清理临时文件失败", extra={"path": temp_file_path, "error": str(e)})
 
         return False
 
+async def process_file(downloader: Downloader, file: Dict[str, Any]) -> Tuple[int, int, Optional[str]]:
+    """
+    下载单个文件
+    返回: (文件ID, 处理状态, 错误信息)，由调用方批量写回数据库
+    """
+    try:
+        success = await downloader.download_file(
+            file['path'],
+            file['sign'],
+            file['size']  # 传入文件大小
+        )
+        if success:
+            logger.info("文件处理完成: %s", file['path'])
+            return file['id'], FILE_STATUS_DONE, None
+        error_msg = "下载失败，已达到最大重试次数"
+        logger.error("文件处理失败", extra={"path": file['path'], "error": error_msg})
+        return file['id'], FILE_STATUS_FAILED, error_msg
+    except Exception as e:
+        logger.error("处理文件出错", extra={"path": file['path'], "error": str(e)})
+        return file['id'], FILE_STATUS_FAILED, str(e)
+
+async def producer(db: Database, queue: asyncio.Queue):
+    """持续从数据库获取未处理的文件放入队列，队列满时阻塞形成背压"""
+    last_id = 0
+    next_release = 0.0
+    while True:
+        try:
+            # 确保数据库连接可用
+            await db.ensure_connected()
+
+            # 定期重置超时仍处于下载中的记录（本进程或其他进程异常退出时遗留）
+            if time.monotonic() >= next_release:
+                released = await db.release_stale_files()
+                next_release = time.monotonic() + STALE_RELEASE_INTERVAL
+                if released:
+                    logger.info("重置遗留的下载中文件", extra={"count": released})
+                    last_id = 0
+
+            # 检查磁盘空间是否满足最低要求
+            if not check_disk_space(SAVE_ROOT_DIR):
+                logger.warning(f"磁盘空间不足{MIN_DISK_SPACE/1024/1024/1024:.2f}GB，休眠后重试")
+                await asyncio.sleep(SLEEP_TIME)
+                continue
+
+            # 领取未处理的文件，领取后的记录不会再被其他进程或下一轮查询取到
+            files = await db.get_unprocessed_files(limit=BATCH_SIZE, after_id=last_id)
+            if not files and last_id:
+                # 已扫描到末尾，从头再查一次，以取到被重置为未处理的记录
+                last_id = 0
+                continue
+            if not files:
+                logger.info("没有更多未处理的文件，休眠后继续")
+                await asyncio.sleep(SLEEP_TIME)
+                continue
+
+            logger.info("开始处理文件", extra={"count": len(files)})
+            last_id = files[-1]['id']
+            for file in files:
+                await queue.put(file)
+
+        except DatabaseError as e:
+            logger.error("数据库操作失败", extra={"error": str(e)})
+            await asyncio.sleep(SLEEP_TIME)
+        except Exception as e:
+            logger.error("获取文件出错", extra={"error": str(e)})
+            await asyncio.sleep(SLEEP_TIME)
+
+async def worker(downloader: Downloader, queue: asyncio.Queue, results: asyncio.Queue, in_flight: Set[int]):
+    """
+    从队列中取出文件下载，并将处理结果交给状态写回协程
+    in_flight: 正在下载的文件ID，退出时由main放回未处理
+    """
+    while True:
+        file = await queue.get()
+        in_flight.add(file['id'])
+        try:
+            results.put_nowait(await process_file(downloader, file))
+            in_flight.discard(file['id'])
+        finally:
+            queue.task_done()
+
+async def write_file_status(db: Database, rows: List[Tuple[int, int, Optional[str]]]):
+    """
+    批量写回处理结果，整批写入失败时拆成两半分别重试，
+    避免个别记录导致整批结果丢失
+    """
+    try:
+        await db.update_file_status_bulk(rows)
+    except Exception as e:
+        if len(rows) == 1:
+            logger.error("更新文件状态失败", extra={"id": rows[0][0], "error": str(e)})
+            return
+        logger.warning("批量更新文件状态失败，拆分后重试", extra={"count": len(rows), "error": str(e)})
+        middle = len(rows) // 2
+        await write_file_status(db, rows[:middle])
+        await write_file_status(db, rows[middle:])
+
+async def status_writer(db: Database, results: asyncio.Queue):
+    """将已积累的处理结果合并为一条UPDATE写回数据库"""
+    while True:
+        rows = [await results.get()]
+        while not results.empty():
+            rows.append(results.get_nowait())
+        try:
+            await write_file_status(db, rows)
+        except asyncio.CancelledError:
+            # 退出时尚未写完的结果放回队列，由main统一写回
+            for row in rows:
+                results.put_nowait(row)
+            raise
+
+def create_resolver() -> aiohttp.abc.AbstractResolver:
+    """优先使用基于aiodns的异步DNS解析器，未安装aiodns时回退到线程池解析"""
+    try:
+        return aiohttp.AsyncResolver()
+    except RuntimeError:
+        logger.warning("未安装aiodns，使用默认DNS解析器")
+        return aiohttp.ThreadedResolver()
+
 async def main():
     # 初始化数据库
     db = Database()
     await db.init_db()
-    
+
+    # 创建全局共享的HTTP会话，复用连接池、DNS缓存和keep-alive连接
+    connector = aiohttp.TCPConnector(
+        resolver=create_resolver(),
+        limit=HTTP_POOL_LIMIT,
+        limit_per_host=max(HTTP_POOL_LIMIT_PER_HOST, DOWNLOAD_CONCURRENCY),
+        keepalive_timeout=HTTP_KEEPALIVE_TIMEOUT,
+        enable_cleanup_closed=True,
+        use_dns_cache=True,
+        ttl_dns_cache=HTTP_DNS_CACHE_TTL
+    )
+    session = aiohttp.ClientSession(connector=connector)
+
+    # 待下载队列：生产者持续取数，DOWNLOAD_CONCURRENCY个下载协程并发消费
+    queue = asyncio.Queue(maxsize=2 * BATCH_SIZE)
+    results = asyncio.Queue()
+    in_flight: Set[int] = set()
+    tasks = []
+
     try:
-        # 无限循环，支持用户中断
-        while True:
-            try:
-                # 确保数据库连接可用
-                await db.ensure_connected()
-                
-                # 检查磁盘空间是否满足最低要求
-                if not check_disk_space(SAVE_ROOT_DIR):
-                    logger.warning(f"磁盘空间不足{MIN_DISK_SPACE/1024/1024/1024:.2f}GB，休眠后重试")
-                    await asyncio.sleep(SLEEP_TIME)
-                    continue
-                    
-                async with aiohttp.ClientSession() as session:
-                    downloader = Downloader(session)
-                    
-                    # 获取未处理的文件
-                    try:
-                        files = await db.get_unprocessed_files(limit=BATCH_SIZE)
-                        if not files:
-                            logger.info("没有更多未处理的文件，休眠后继续")
-                            await asyncio.sleep(SLEEP_TIME)
-                            continue
-
-                        logger.info("开始处理文件", extra={"count": len(files)})
-                        
-                        for file in files:
-                            try:
-                                success = await downloader.download_file(
-                                    file['path'], 
-                                    file['sign'],
-                                    file['size']  # 传入文件大小
-                                )
-                                if success:
-                                    await db.update_file_status(file['id'], 1)
-                                    logger.info("文件处理完成", extra={"path": file['path']})
-                                else:
-                                    error_msg = "下载失败，已达到最大重试次数"
-                                    await db.update_file_status(file['id'], -1, error_msg)
-                                    logger.error("文件处理失败", extra={"path": file['path'], "error": error_msg})
-                            except Exception as e:
-                                logger.error("处理文件出错", extra={"path": file['path'], "error": str(e)})
-                                await db.update_file_status(file['id'], -1, str(e))
-                    except DatabaseError as e:
-                        logger.error("数据库操作失败", extra={"error": str(e)})
-                        await asyncio.sleep(SLEEP_TIME)
-                        continue
-                    
-                    logger.info(f"本次循环完成，休眠{SLEEP_TIME}秒")
-                    await asyncio.sleep(SLEEP_TIME)
-            
-            except Exception as e:
-                logger.error("循环执行出错", extra={"error": str(e)})
-                await asyncio.sleep(SLEEP_TIME)
+        downloader = Downloader(session)
+
+        await db.ensure_indexes()
+
+        tasks.append(asyncio.create_task(producer(db, queue)))
+        tasks.append(asyncio.create_task(status_writer(db, results)))
+        tasks.extend(
+            asyncio.create_task(worker(downloader, queue, results, in_flight))
+            for _ in range(DOWNLOAD_CONCURRENCY)
+        )
+        await asyncio.gather(*tasks)
 
     except KeyboardInterrupt:
         logger.info("收到中断信号，程序退出")
     except Exception as e:
         logger.error("程序执行出错", extra={"error": str(e)})
     finally:
+        # 停止所有协程后再收尾，避免与仍在运行的下载或写回并发
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+
+        # 写回已完成但尚未入库的结果，正在下载和已领取未开始的文件放回未处理
+        rows = []
+        while not results.empty():
+            rows.append(results.get_nowait())
+        rows.extend((file_id, FILE_STATUS_PENDING, None) for file_id in in_flight)
+        while not queue.empty():
+            rows.append((queue.get_nowait()['id'], FILE_STATUS_PENDING, None))
+        if rows:
+            await write_file_status(db, rows)
+        await session.close()
         await db.close()
 
 if __name__ == "__main__":
@@ -1,4 +1,5 @@
-from pydantic_settings import BaseSettings
+from functools import lru_cache
+from pydantic_settings import BaseSettings, SettingsConfigDict
 from typing import Set
 
 
@@ -17,7 +18,7 @@ class Settings(BaseSettings):
     DEBUG: bool = False  # 调试模式开关
 
     # 文件保存配置
-    SAVE_ROOT_DIR: str  # 文件保存根目录
+    SAVE_ROOT_DIR: str = "/data"  # 文件保存根目录
     PRESERVE_PATH_STRUCTURE: bool = True  # 是否保留原始路径结构
     
     # 磁盘预留空间-10GB
@@ -29,6 +30,8 @@ class Settings(BaseSettings):
     GET_FILE_INFO_HOST: str
     # 每次处理的文件数量
     BATCH_SIZE: int = 5
+    # 同时下载的文件数量
+    DOWNLOAD_CONCURRENCY: int = 5
     # 每次循环后休眠时间(秒)
     SLEEP_TIME: int = 60
     # 下载成功后删除
@@ -41,6 +44,8 @@ class Settings(BaseSettings):
     MYSQL_USER: str  # MySQL用户名
     MYSQL_PASSWORD: str  # MySQL密码
     MYSQL_ROOT_PASSWORD: str  # MySQL root密码
+    DB_POOL_MIN: int = 4  # remove-quark-file.py数据库连接池最小连接数
+    DB_POOL_MAX: int = 32  # remove-quark-file.py数据库连接池最大连接数
 
     # 日志配置
     LOG_LEVEL: str = "INFO"  # 日志级别
@@ -50,15 +55,13 @@ class Settings(BaseSettings):
     LOG_FILE_MAX_BYTES: int = 10 * 1024 * 1024  # 单个日志文件最大大小（10MB）
     LOG_FILE_BACKUP_COUNT: int = 5  # 日志文件备份数量
 
-    class Config:
-        """配置类设置
+    # case_sensitive: 区分大小写
+    # env_file: 环境变量文件路径
+    # frozen: 配置加载后不可修改
+    model_config = SettingsConfigDict(case_sensitive=True, env_file=".env", frozen=True)
 
-        case_sensitive: 区分大小写
-        env_file: 环境变量文件路径
-        """
 
-        case_sensitive = True
-        env_file = ".env"
-
-
-settings = Settings()  # 创建全局配置实例
\ No newline at end of file
+@lru_cache(maxsize=1)
+def get_settings() -> Settings:
+    """获取全局配置实例，.env只解析一次"""
+    return Settings()
\ No newline at end of file
@@ -1,17 +1,21 @@
 import os
 import sys
+import errno
 import asyncio
 import aiohttp
 import aiomysql
+import aiofiles
 import shutil
 import time
-from typing import Dict, Any, Optional
+from typing import Dict, Any, List, Optional, Set, Tuple
 from pathlib import Path
 from datetime import datetime
-from config import settings
+from config import get_settings
 from logger import Logger
 import urllib.parse
 
+settings = get_settings()
+
 # 初始化日志
 logger = Logger("downloader").logger
 
@@ -23,21 +27,54 @@ MYSQL_CONFIG = {
     'password': settings.MYSQL_ROOT_PASSWORD,  # 使用root密码
     'db': settings.MYSQL_DATABASE,
     'charset': 'utf8mb4',
-    'autocommit': True  # 启用自动提交
+    'autocommit': True,  # 启用自动提交
+    'minsize': int(settings.DOWNLOAD_CONCURRENCY),  # 连接池最小连接数，与下载并发数一致
+    'maxsize': int(settings.DOWNLOAD_CONCURRENCY) * 2,  # 连接池最大连接数
+    'pool_recycle': 1800  # 连接回收时间(秒)，避免使用被服务端断开的连接
 }
 
 # 下载配置
 BATCH_SIZE = int(settings.BATCH_SIZE)  # 每次处理的文件数量
+DOWNLOAD_CONCURRENCY = int(settings.DOWNLOAD_CONCURRENCY)  # 同时下载的文件数量
 SLEEP_TIME = int(settings.SLEEP_TIME)  # 每次循环后休眠时间(秒)
 DELETE_AFTER_DOWNLOAD = settings.DELETE_AFTER_DOWNLOAD  # 下载成功后是否删除文件
 MIN_DISK_SPACE = int(settings.DISK_FREE)  # 最小磁盘空间要求(10GB)
 REMOVE_PREFIX = settings.GET_ROOT_DIR  # 需要移除的路径前缀
 MAX_DB_RETRIES = 3  # 数据库操作最大重试次数
+MAX_DOWNLOAD_RETRIES = 3  # 单个文件下载最大重试次数
+DOWNLOAD_RETRY_DELAY = 5  # 下载重试基础延迟（秒）
 DB_RETRY_DELAY = 5  # 数据库重试延迟（秒）
+DOWNLOAD_CHUNK = 1 << 20  # 写盘缓冲区大小(1MB)
+DISK_CHECK_INTERVAL = 5  # 磁盘剩余空间缓存有效期(秒)
+
+# HTTP连接池配置
+HTTP_POOL_LIMIT = 64  # 连接池总连接数上限
+HTTP_POOL_LIMIT_PER_HOST = 16  # 单个主机的连接数上限
+HTTP_KEEPALIVE_TIMEOUT = 75  # keep-alive连接保持时间(秒)
+HTTP_DNS_CACHE_TTL = 300  # DNS缓存时间(秒)
+
+# 文件处理状态
+FILE_STATUS_DONE = 1  # 已下载
+FILE_STATUS_FAILED = 2  # 下载失败
+
+# 单次下载尝试的结果
+ATTEMPT_DONE = "done"  # 临时文件已完整，可以重命名为最终文件
+ATTEMPT_DISCARDED = "discarded"  # 已完整下载到匿名文件，无需保存
+ATTEMPT_PARTIAL = "partial"  # 连接提前结束，可以断点续传
+ATTEMPT_FAILED = "failed"  # 出错，等待后重试
+ATTEMPT_NO_SPACE = "no_space"  # 磁盘空间不足，放弃下载
 
 # 文件保存配置
-SAVE_ROOT_DIR = "/data"  # 文件保存根目录
-PRESERVE_PATH_STRUCTURE = True  # 是否保留原始路径结构
+SAVE_ROOT_DIR = settings.SAVE_ROOT_DIR  # 文件保存根目录
+PRESERVE_PATH_STRUCTURE = settings.PRESERVE_PATH_STRUCTURE  # 是否保留原始路径结构
+
+# 路径处理时使用的预计算常量
+REMOVE_PREFIX_LEN = len(REMOVE_PREFIX)
+_SAVE_ROOT = SAVE_ROOT_DIR.rstrip('/') or '/'
+# 路径清理：移除引号（单引号和双引号），空格替换为下划线
+_PATH_TRANSLATION = str.maketrans({"'": None, '"': None, ' ': '_'})
+# 文件名清理：移除文件系统不允许的字符
+_FILENAME_TRANSLATION = str.maketrans(dict.fromkeys('<>:"/\\|?*'))
 
 class DownloadError(Exception):
     """下载错误的自定义异常"""
@@ -47,8 +84,25 @@ class DatabaseError(Exception):
     """数据库错误的自定义异常"""
     pass
 
-def check_disk_space(path: str, required_space: int = MIN_DISK_SPACE) -> bool:
-    """检查磁盘空间是否足够"""
+# 本进程中已确认存在的目录，同目录的后续文件无需再调用makedirs
+_ensured_dirs: Set[str] = set()
+
+# 最近一次查询到的磁盘剩余空间：(查询时间, 剩余字节数)
+# 下载路径都位于SAVE_ROOT_DIR下，共用同一份缓存
+_disk_free_cache: Optional[Tuple[float, int]] = None
+
+def check_disk_space(path: str, required_space: int = MIN_DISK_SPACE, use_cache: bool = False) -> bool:
+    """
+    检查磁盘空间是否足够
+    use_cache: 在DISK_CHECK_INTERVAL内复用上次查询到的剩余空间，并扣除期间已放行的文件大小
+    """
+    global _disk_free_cache
+    if use_cache and _disk_free_cache is not None:
+        checked_at, free = _disk_free_cache
+        if time.monotonic() - checked_at < DISK_CHECK_INTERVAL and free > required_space:
+            _disk_free_cache = (checked_at, free - required_space)
+            return True
+
     try:
         # 首先检查路径是否存在
         if not os.path.exists(path):
@@ -62,10 +116,11 @@ def check_disk_space(path: str, required_space: int = MIN_DISK_SPACE) -> bool:
 
         # 获取路径的绝对路径
         abs_path = os.path.abspath(path)
-        logger.info("检查路径", extra={"path": abs_path})
+        logger.debug("检查路径", extra={"path": abs_path})
 
         # 获取磁盘使用情况
         total, used, free = shutil.disk_usage(abs_path)
+        _disk_free_cache = (time.monotonic(), free)
         
         # 转换为GB进行记录
         total_gb = total / (1024 ** 3)
@@ -73,7 +128,7 @@ def check_disk_space(path: str, required_space: int = MIN_DISK_SPACE) -> bool:
         free_gb = free / (1024 ** 3)
         required_gb = required_space / (1024 ** 3)
         
-        logger.info(
+        logger.debug(
             "磁盘空间信息", 
             extra={
                 "path": abs_path,
@@ -124,6 +179,24 @@ def check_disk_space(path: str, required_space: int = MIN_DISK_SPACE) -> bool:
         })
         return False
 
+def _stat_size(path: str) -> Optional[int]:
+    """获取文件大小，文件不存在时返回None"""
+    try:
+        return os.stat(path).st_size
+    except FileNotFoundError:
+        return None
+
+def _open_anonymous_file(directory: str) -> Optional[int]:
+    """在目录中创建未链接的匿名文件(O_TMPFILE)，关闭后自动释放；系统或文件系统不支持时返回None"""
+    if not hasattr(os, 'O_TMPFILE'):
+        return None
+    try:
+        return os.open(directory, os.O_TMPFILE | os.O_WRONLY, 0o600)
+    except OSError as e:
+        if e.errno in (errno.EOPNOTSUPP, errno.EISDIR, errno.EINVAL):
+            return None
+        raise
+
 def ensure_directory(path: str) -> bool:
     """确保目录存在，如果不存在则创建"""
     try:
@@ -136,19 +209,16 @@ def ensure_directory(path: str) -> bool:
 class Database:
     def __init__(self):
         self.pool = None
+        # 串行化连接池重建，避免并发重试时各自创建连接池
+        self._pool_lock = asyncio.Lock()
 
     async def ensure_connected(self):
-        """确保数据库连接可用"""
-        if self.pool is None or self.pool._closed:
-            await self.init_db()
-        try:
-            async with self.pool.acquire() as conn:
-                async with conn.cursor() as cur:
-                    await cur.execute("SELECT 1")
-        except Exception as e:
-            logger.warning("数据库连接检查失败，尝试重新连接", extra={"error": str(e)})
-            await self.close()
-            await self.init_db()
+        """确保数据库连接池可用，只有连接池不存在或已关闭时才重建"""
+        if self.pool is not None and not self.pool._closed:
+            return
+        async with self._pool_lock:
+            if self.pool is None or self.pool._closed:
+                await self.init_db()
 
     async def init_db(self):
         """初始化数据库连接池"""
@@ -157,10 +227,6 @@ class Database:
         
         while retries < MAX_DB_RETRIES:
             try:
-                if self.pool:
-                    self.pool.close()
-                    await self.pool.wait_closed()
-                
                 self.pool = await aiomysql.create_pool(**MYSQL_CONFIG)
                 logger.info("数据库连接池初始化成功")
                 return
@@ -184,7 +250,10 @@ class Database:
             self.pool = None
 
     async def execute_with_retry(self, operation):
-        """使用重试机制执行数据库操作"""
+        """
+        使用重试机制执行数据库操作
+        失败时只重试操作本身，失效的连接由aiomysql在归还时丢弃，不重建共享的连接池
+        """
         retries = 0
         last_error = None
         
@@ -204,39 +273,72 @@ class Database:
                     continue
                 raise DatabaseError(f"数据库操作失败，已达到最大重试次数: {last_error}")
 
-    async def get_unprocessed_files(self, limit: int = 10):
-        """获取未处理的文件记录"""
+    async def ensure_indexes(self):
+        """确保存在(is_processed, id)索引，避免按状态和ID分页查询时全表扫描"""
+        async def _operation():
+            async with self.pool.acquire() as conn:
+                async with conn.cursor() as cur:
+                    # 只认前两列恰好为(is_processed, id)的索引，(is_processed, dir_path_l3)等不满足键集分页
+                    await cur.execute('''
+                        SELECT INDEX_NAME 
+                        FROM information_schema.STATISTICS 
+                        WHERE TABLE_SCHEMA = DATABASE() AND TABLE_NAME = 'files' 
+                        GROUP BY INDEX_NAME 
+                        HAVING SUM(SEQ_IN_INDEX = 1 AND COLUMN_NAME = 'is_processed') = 1 
+                        AND SUM(SEQ_IN_INDEX = 2 AND COLUMN_NAME = 'id') = 1
+                    ''')
+                    if await cur.fetchone():
+                        return
+                    logger.info("创建索引", extra={"index": "idx_files_unprocessed"})
+                    await cur.execute('''
+                        CREATE INDEX idx_files_unprocessed ON files (is_processed, id) 
+                        ALGORITHM=INPLACE LOCK=NONE
+                    ''')
+        await self.execute_with_retry(_operation)
+
+    async def get_unprocessed_files(self, limit: int = 10, after_id: int = 0):
+        """
+        获取未处理的文件记录
+        after_id: 只查询ID大于该值的记录（键集分页），避免重复扫描已处理的区间
+        """
         async def _operation():
             async with self.pool.acquire() as conn:
                 async with conn.cursor(aiomysql.DictCursor) as cur:
                     await cur.execute('''
                         SELECT id, path, sign, size 
                         FROM files 
-                        WHERE is_processed = 0 
+                        WHERE is_processed = 0 AND id > %s 
+                        ORDER BY id 
                         LIMIT %s
-                    ''', (limit,))
+                    ''', (after_id, limit))
                     return await cur.fetchall()
         return await self.execute_with_retry(_operation)
 
-    async def update_file_status(self, file_id: int, status: int, error_msg: str = None):
-        """更新文件处理状态"""
+    async def update_file_status_bulk(self, rows: List[Tuple[int, int, Optional[str]]]):
+        """
+        批量更新文件处理状态，一条UPDATE语句完成整批更新
+        rows: [(文件ID, 状态, 错误信息)]，错误信息为空时保留原值
+        """
+        if not rows:
+            return
+
+        status_cases = ' '.join(['WHEN %s THEN %s'] * len(rows))
+        error_cases = ' '.join(['WHEN %s THEN COALESCE(%s, error_message)'] * len(rows))
+        id_placeholders = ', '.join(['%s'] * len(rows))
+        params = [value for file_id, status, _ in rows for value in (file_id, status)]
+        params += [value for file_id, _, error_msg in rows for value in (file_id, error_msg or None)]
+        params += [file_id for file_id, _, _ in rows]
+
         async def _operation():
             async with self.pool.acquire() as conn:
                 async with conn.cursor() as cur:
-                    if error_msg:
-                        await cur.execute('''
-                            UPDATE files 
-                            SET is_processed = %s, error_message = %s, 
-                                updated_at = CURRENT_TIMESTAMP 
-                            WHERE id = %s
-                        ''', (status, error_msg, file_id))
-                    else:
-                        await cur.execute('''
-                            UPDATE files 
-                            SET is_processed = %s, updated_at = CURRENT_TIMESTAMP 
-                            WHERE id = %s
-                        ''', (status, file_id))
-                    await conn.commit()
+                    await cur.execute(f'''
+                        UPDATE files 
+                        SET is_processed = CASE id {status_cases} END, 
+                            error_message = CASE id {error_cases} END, 
+                            updated_at = CURRENT_TIMESTAMP 
+                        WHERE id IN ({id_placeholders})
+                    ''', params)
         await self.execute_with_retry(_operation)
 
 class Downloader:
@@ -253,64 +355,114 @@ class Downloader:
         """
         # 移除前缀
         if file_path.startswith(REMOVE_PREFIX):
-            file_path = file_path[len(REMOVE_PREFIX):]
+            file_path = file_path[REMOVE_PREFIX_LEN:]
 
-        # 处理文件路径中的特殊字符
-        # 1. 移除路径中的引号（单引号和双引号）
-        file_path = file_path.replace("'", "").replace('"', "")
-        # 2. 处理文件路径，保留原始文件名
-        file_path = file_path.lstrip('/')
-        
-        # 根据配置决定是否保留原始路径结构
-        if PRESERVE_PATH_STRUCTURE:
-            # 保留原始路径结构，但使用保存根目录
-            # 替换路径中的空格
-            clean_path = file_path.replace(' ', '_')
-            full_path = os.path.join(SAVE_ROOT_DIR, clean_path)
+        # 处理文件路径中的特殊字符：移除引号（单引号和双引号），空格替换为下划线
+        file_path = file_path.translate(_PATH_TRANSLATION).lstrip('/')
+
+        # 一次切分出目录和文件名，根据配置决定是否保留原始路径结构
+        head, _, final_filename = file_path.rpartition('/')
+        if PRESERVE_PATH_STRUCTURE and head:
+            target_dir = os.path.join(_SAVE_ROOT, head)
         else:
-            # 不保留路径结构，直接保存到根目录
-            final_filename = os.path.basename(file_path)
-            # 替换文件名中的空格
-            final_filename = final_filename.replace(' ', '_')
-            full_path = os.path.join(SAVE_ROOT_DIR, final_filename)
-        
-        target_dir = os.path.dirname(full_path)
-        final_filename = os.path.basename(full_path)
-        
+            target_dir = _SAVE_ROOT
+
         # 处理文件名中的特殊字符
-        # 1. 移除文件名开头和结尾的空格
-        final_filename = final_filename.strip()
-        # 2. 替换文件名中的所有空格为下划线
-        final_filename = final_filename.replace(' ', '_')
-        # 3. 移除或替换可能导致问题的特殊字符
-        final_filename = ''.join(c for c in final_filename if c.isprintable() and c not in '<>:"/\\|?*')
+        # 1. 移除文件名开头和结尾的空白字符
+        # 2. 移除可能导致问题的特殊字符
+        final_filename = final_filename.strip().translate(_FILENAME_TRANSLATION)
+        # 3. 移除不可打印字符（常见情况下整串可打印，无需逐字符处理）
+        if not final_filename.isprintable():
+            final_filename = ''.join(c for c in final_filename if c.isprintable())
         
         # 如果文件名为空，使用时间戳作为文件名
         if not final_filename:
             timestamp = datetime.now().strftime('%Y%m%d_%H%M%S')
             file_ext = os.path.splitext(file_path)[1] or '.unknown'
             final_filename = f"file_{timestamp}{file_ext}"
-        
-        # 确保目标目录存在
-        if not ensure_directory(target_dir):
-            raise DownloadError(f"无法创建目标目录: {target_dir}")
-            
-        # 创建临时文件名（使用原始文件名的 base 部分）
-        base_name = os.path.splitext(final_filename)[0]
-        file_ext = os.path.splitext(final_filename)[1]
-        temp_filename = f"{base_name}.downloading{file_ext}"
+
+        # 创建临时文件名（使用原始文件名的 base 部分），目标目录由download_file创建
+        base_name, dot, file_ext = final_filename.rpartition('.')
+        if base_name:
+            temp_filename = f"{base_name}.downloading{dot}{file_ext}"
+        else:
+            temp_filename = f"{final_filename}.downloading"
 
         return target_dir, temp_filename, final_filename
 
-    async def _get_file_size(self, url: str) -> Optional[int]:
-        """获取远程文件大小"""
-        try:
-            async with self.session.head(url) as response:
-                if response.status == 200:
-                    return int(response.headers.get('Content-Length', 0))
-        except Exception as e:
-            logger.error("获取文件大小失败", extra={"error": str(e)})
-        return None
+    async def _attempt(self, download_url: str, target_dir: str, temp_file_path: str, file_size: int) -> str:
+        """
+        执行一次下载尝试，网络或写盘出错时抛出异常
+        返回: ATTEMPT_DONE（临时文件已完整）、ATTEMPT_DISCARDED（已下载到匿名文件并释放）、
+              ATTEMPT_PARTIAL（连接提前结束，可断点续传）或 ATTEMPT_NO_SPACE（磁盘空间不足）
+        """
+        # 获取已下载的文件大小，临时文件不存在时（包括0字节文件）需要下载一次以创建文件
+        local_size = await asyncio.to_thread(_stat_size, temp_file_path)
+        if local_size == file_size:
+            return ATTEMPT_DONE
+        local_size = local_size or 0
+        if local_size > file_size:
+            # 临时文件比远端文件还大，无法续传，重新下载
+            await asyncio.to_thread(os.remove, temp_file_path)
+            local_size = 0
+
+        # 设置断点续传的header
+        headers = {}
+        if local_size > 0:
+            headers['Range'] = f'bytes={local_size}-'
+
+        async with self.session.get(download_url, headers=headers) as response:
+            if response.status not in (200, 206):
+                raise DownloadError(f"下载失败，状态码: {response.status}")
+            if response.status == 200:
+                # 服务端忽略了Range，返回的是完整文件，从头写入
+                local_size = 0
+
+            # 从响应头获取远端文件总大小，206响应从Content-Range中取
+            total = int(response.headers.get('Content-Length', 0))
+            if response.status == 206:
+                _, _, total_str = response.headers.get('Content-Range', '').rpartition('/')
+                total = int(total_str) if total_str.isdigit() else 0
+            if total and total != file_size:
+                raise DownloadError(f"文件大小不匹配，期望：{file_size}，远端：{total}")
+
+            # 检查剩余需要下载的数据是否放得下
+            if not check_disk_space(target_dir, file_size - local_size, use_cache=True):
+                return ATTEMPT_NO_SPACE
+
+            # 下载后即删除时写入匿名临时文件，关闭即释放，省去重命名和删除
+            fd = None
+            if DELETE_AFTER_DOWNLOAD and local_size == 0:
+                fd = await asyncio.to_thread(_open_anonymous_file, target_dir)
+
+            # 以追加模式打开文件，使用aiofiles避免写盘阻塞事件循环
+            mode = 'ab' if local_size > 0 else 'wb'
+            written = 0
+            async with aiofiles.open(temp_file_path if fd is None else fd, mode) as f:
+                # 收到的数据块合并到缓冲区，凑满DOWNLOAD_CHUNK后再写入，减少线程池调度次数
+                buffer = bytearray()
+                async for chunk, _ in response.content.iter_chunks():
+                    buffer += chunk
+                    if len(buffer) >= DOWNLOAD_CHUNK:
+                        await f.write(buffer)
+                        written += len(buffer)
+                        buffer.clear()
+                if buffer:
+                    await f.write(buffer)
+                    written += len(buffer)
+
+        # 检查下载的文件大小是否正确
+        downloaded_size = local_size + written
+        if downloaded_size > file_size:
+            if fd is None:
+                await asyncio.to_thread(os.remove, temp_file_path)
+            raise DownloadError(f"文件大小不匹配，期望：{file_size}，实际：{downloaded_size}")
+        if downloaded_size < file_size:
+            # 匿名文件关闭后数据已丢失，只能作为失败重新下载
+            if fd is not None:
+                raise DownloadError(f"文件大小不匹配，期望：{file_size}，实际：{downloaded_size}")
+            return ATTEMPT_PARTIAL
+        return ATTEMPT_DISCARDED if fd is not None else ATTEMPT_DONE
 
     async def download_file(self, file_path: str, sign: str, file_size: int) -> bool:
         """
@@ -320,110 +472,138 @@ class Downloader:
         target_dir, temp_filename, final_filename = self._get_download_path(file_path)
         
         # 创建目标目录
-        os.makedirs(target_dir, exist_ok=True)
+        if target_dir not in _ensured_dirs:
+            await asyncio.to_thread(os.makedirs, target_dir, exist_ok=True)
+            _ensured_dirs.add(target_dir)
         
         temp_file_path = os.path.join(target_dir, temp_filename)
         final_file_path = os.path.join(target_dir, final_filename)
         
         # 检查文件是否已存在
-        if os.path.exists(final_file_path):
+        if await asyncio.to_thread(os.path.exists, final_file_path):
             logger.info("文件已存在", extra={"path": final_file_path})
             return True
 
         encoded_path = urllib.parse.quote(file_path)
         # 构建最终下载链接
         download_url = f"{settings.DOWNLOAD_HOST}{encoded_path}?sign={sign}"
-        print(download_url)
         
-        # 检查磁盘空间是否足够
-        if not check_disk_space(target_dir, file_size):
-            logger.error("磁盘空间不足", extra={"path": file_path, "size": file_size})
-            return False
-
-        retries = 0
-        while retries < 3:  # 最大重试次数
+        for attempt in range(1, MAX_DOWNLOAD_RETRIES + 1):
             try:
-                # 获取已下载的文件大小
-                local_size = os.path.getsize(temp_file_path) if os.path.exists(temp_file_path) else 0
-                
-                # 设置断点续传的header
-                headers = {}
-                if local_size > 0:
-                    headers['Range'] = f'bytes={local_size}-'
-
-                async with self.session.get(download_url, headers=headers) as response:
-                    if response.status not in (200, 206):
-                        raise DownloadError(f"下载失败，状态码: {response.status}")
-
-                    # 以追加模式打开文件
-                    mode = 'ab' if local_size > 0 else 'wb'
-                    with open(temp_file_path, mode) as f:
-                        async for chunk in response.content.iter_chunked(8192):
-                            if chunk:
-                                f.write(chunk)
-
-                # 检查下载的文件大小是否正确
-                if os.path.getsize(temp_file_path) != file_size:
-                    raise DownloadError(f"文件大小不匹配，期望：{file_size}，实际：{os.path.getsize(temp_file_path)}")
-
-                # 下载完成后重命名文件
-                os.rename(temp_file_path, final_file_path)
+                result = await self._attempt(download_url, target_dir, temp_file_path, file_size)
+            except Exception as e:
+                result = ATTEMPT_FAILED
+                logger.error("下载失败", extra={
+                    "retry": f"{attempt}/{MAX_DOWNLOAD_RETRIES}",
+                    "path": file_path,
+                    "error": str(e)
+                })
+
+            if result == ATTEMPT_NO_SPACE:
+                logger.error("磁盘空间不足", extra={"path": file_path, "size": file_size})
+                return False
+
+            if result == ATTEMPT_DISCARDED:
+                logger.info("文件下载完成（未保存）", extra={"path": file_path})
+                return True
+
+            if result == ATTEMPT_DONE:
+                # 下载完成后原子替换为最终文件
+                await asyncio.to_thread(os.replace, temp_file_path, final_file_path)
                 logger.info("文件下载完成", extra={"path": final_file_path})
-                
+
                 # 如果配置了下载后删除，则删除文件
                 if DELETE_AFTER_DOWNLOAD:
                     try:
-                        os.remove(final_file_path)
+                        await asyncio.to_thread(os.remove, final_file_path)
                         logger.info("文件已删除", extra={"path": final_file_path})
                     except Exception as e:
                         logger.error("删除文件失败", extra={"path": final_file_path, "error": str(e)})
-                
+
                 return True
 
-            except Exception as e:
-                retries += 1
-                logger.error("下载失败", extra={
-                    "retry": f"{retries}/3",
-                    "path": file_path,
-                    "error": str(e)
+            if result == ATTEMPT_PARTIAL:
+                # 连接提前结束但数据有效，立即断点续传
+                logger.warning("文件未下载完整，继续下载", extra={
+                    "retry": f"{attempt}/{MAX_DOWNLOAD_RETRIES}",
+                    "path": file_path
                 })
-                await asyncio.sleep(5 * retries)  # 指数退避
-                
-                # 检查临时文件是否完整
-                if os.path.exists(temp_file_path):
-                    if os.path.getsize(temp_file_path) != file_size:
-                        # 文件不完整，下次继续下载
-                        continue
-                    else:
-                        # 文件已完整下载，重命名并返回
-                        os.rename(temp_file_path, final_file_path)
-                        
-                        # 如果配置了下载后删除，则删除文件
-                        if DELETE_AFTER_DOWNLOAD:
-                            try:
-                                os.remove(final_file_path)
-                                logger.info("文件已删除", extra={"path": final_file_path})
-                            except Exception as e:
-                                logger.error("删除文件失败", extra={"path": final_file_path, "error": str(e)})
-                        
-                        return True
+                continue
+
+            if attempt < MAX_DOWNLOAD_RETRIES:
+                await asyncio.sleep(DOWNLOAD_RETRY_DELAY * attempt)  # 逐次增加等待时间
 
         # 清理垃圾文件
-        if os.path.exists(temp_file_path):
-            try:
-                os.remove(temp_file_path)
-                logger.info("清理临时文件", extra={"path": temp_file_path})
-            except Exception as e:
-                logger.error("清理临时文件失败", extra={"path": temp_file_path, "error": str(e)})
+        try:
+            await asyncio.to_thread(os.remove, temp_file_path)
+            logger.info("清理临时文件", extra={"path": temp_file_path})
+        except FileNotFoundError:
+            pass
+        except Exception as e:
+            logger.error("清理临时文件失败", extra={"path": temp_file_path, "error": str(e)})
 
         return False
 
+async def process_file(downloader: Downloader, semaphore: asyncio.Semaphore, file: Dict[str, Any]) -> Tuple[int, int, Optional[str]]:
+    """
+    下载单个文件
+    返回: (文件ID, 处理状态, 错误信息)，由调用方批量写回数据库
+    """
+    async with semaphore:
+        try:
+            success = await downloader.download_file(
+                file['path'],
+                file['sign'],
+                file['size']  # 传入文件大小
+            )
+            if success:
+                logger.info("文件处理完成", extra={"path": file['path']})
+                return file['id'], FILE_STATUS_DONE, None
+            error_msg = "下载失败，已达到最大重试次数"
+            logger.error("文件处理失败", extra={"path": file['path'], "error": error_msg})
+            return file['id'], FILE_STATUS_FAILED, error_msg
+        except Exception as e:
+            logger.error("处理文件出错", extra={"path": file['path'], "error": str(e)})
+            return file['id'], FILE_STATUS_FAILED, str(e)
+
+async def write_file_status(db: Database, rows: List[Tuple[int, int, Optional[str]]]):
+    """
+    批量写回处理结果，整批写入失败时拆成两半分别重试，
+    避免个别记录导致整批结果丢失
+    """
+    try:
+        await db.update_file_status_bulk(rows)
+    except Exception as e:
+        if len(rows) == 1:
+            logger.error("更新文件状态失败", extra={"id": rows[0][0], "error": str(e)})
+            return
+        logger.warning("批量更新文件状态失败，拆分后重试", extra={"count": len(rows), "error": str(e)})
+        middle = len(rows) // 2
+        await write_file_status(db, rows[:middle])
+        await write_file_status(db, rows[middle:])
+
 async def main():
     # 初始化数据库
     db = Database()
     await db.init_db()
-    
+
+    # 限制同时下载的文件数量
+    semaphore = asyncio.Semaphore(DOWNLOAD_CONCURRENCY)
+
+    # 创建全局共享的HTTP会话，复用连接池、DNS缓存和keep-alive连接
+    connector = aiohttp.TCPConnector(
+        limit=max(HTTP_POOL_LIMIT, DOWNLOAD_CONCURRENCY * 2),
+        limit_per_host=max(HTTP_POOL_LIMIT_PER_HOST, DOWNLOAD_CONCURRENCY),
+        keepalive_timeout=HTTP_KEEPALIVE_TIMEOUT,
+        ttl_dns_cache=HTTP_DNS_CACHE_TTL
+    )
+    session = aiohttp.ClientSession(connector=connector)
+
     try:
+        await db.ensure_indexes()
+        downloader = Downloader(session)
+        last_id = 0
+
         # 无限循环，支持用户中断
         while True:
             try:
@@ -435,44 +615,39 @@ async def main():
                     logger.warning(f"磁盘空间不足{MIN_DISK_SPACE/1024/1024/1024:.2f}GB，休眠后重试")
                     await asyncio.sleep(SLEEP_TIME)
                     continue
-                    
-                async with aiohttp.ClientSession() as session:
-                    downloader = Downloader(session)
-                    
-                    # 获取未处理的文件
-                    try:
-                        files = await db.get_unprocessed_files(limit=BATCH_SIZE)
-                        if not files:
-                            logger.info("没有更多未处理的文件，休眠后继续")
-                            await asyncio.sleep(SLEEP_TIME)
-                            continue
-
-                        logger.info("开始处理文件", extra={"count": len(files)})
-                        
-                        for file in files:
-                            try:
-                                success = await downloader.download_file(
-                                    file['path'], 
-                                    file['sign'],
-                                    file['size']  # 传入文件大小
-                                )
-                                if success:
-                                    await db.update_file_status(file['id'], 1)
-                                    logger.info("文件处理完成", extra={"path": file['path']})
-                                else:
-                                    error_msg = "下载失败，已达到最大重试次数"
-                                    await db.update_file_status(file['id'], -1, error_msg)
-                                    logger.error("文件处理失败", extra={"path": file['path'], "error": error_msg})
-                            except Exception as e:
-                                logger.error("处理文件出错", extra={"path": file['path'], "error": str(e)})
-                                await db.update_file_status(file['id'], -1, str(e))
-                    except DatabaseError as e:
-                        logger.error("数据库操作失败", extra={"error": str(e)})
+
+                # 获取未处理的文件
+                try:
+                    files = await db.get_unprocessed_files(limit=BATCH_SIZE, after_id=last_id)
+                    if not files and last_id:
+                        # 已扫描到末尾，从头再查一次，以取到被重置为未处理的记录
+                        last_id = 0
+                        continue
+                    if not files:
+                        logger.info("没有更多未处理的文件，休眠后继续")
                         await asyncio.sleep(SLEEP_TIME)
                         continue
-                    
-                    logger.info(f"本次循环完成，休眠{SLEEP_TIME}秒")
+
+                    last_id = files[-1]['id']
+                    logger.info("开始处理文件", extra={"count": len(files)})
+
+                    # 并发下载本批次的文件，由信号量限制同时下载的数量
+                    results = await asyncio.gather(
+                        *(process_file(downloader, semaphore, file) for file in files),
+                        return_exceptions=True
+                    )
+
+                    # 整批写回处理状态
+                    await write_file_status(
+                        db, [result for result in results if isinstance(result, tuple)]
+                    )
+                except DatabaseError as e:
+                    logger.error("数据库操作失败", extra={"error": str(e)})
                     await asyncio.sleep(SLEEP_TIME)
+                    continue
+
+                logger.info(f"本次循环完成，休眠{SLEEP_TIME}秒")
+                await asyncio.sleep(SLEEP_TIME)
             
             except Exception as e:
                 logger.error("循环执行出错", extra={"error": str(e)})
@@ -483,6 +658,7 @@ async def main():
     except Exception as e:
         logger.error("程序执行出错", extra={"error": str(e)})
     finally:
+        await session.close()
         await db.close()
 
 if __name__ == "__main__":
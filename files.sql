@@ -4,10 +4,12 @@ CREATE TABLE `files` (
   `path` varchar(2000) CHARACTER SET utf8mb4 COLLATE utf8mb4_0900_ai_ci NOT NULL DEFAULT '' COMMENT '文件路径',
   `size` int unsigned NOT NULL DEFAULT '0' COMMENT '文件大小',
   `sign` varchar(255) CHARACTER SET utf8mb4 COLLATE utf8mb4_0900_ai_ci NOT NULL DEFAULT '' COMMENT '文件签名',
-  `is_processed` tinyint unsigned NOT NULL DEFAULT '0' COMMENT '状态 0-为下载 1-已下载 2-下载失败',
+  `is_processed` tinyint unsigned NOT NULL DEFAULT '0' COMMENT '状态 0-为下载 1-已下载 2-下载失败 3-下载中',
   `error_message` varchar(200) CHARACTER SET utf8mb4 COLLATE utf8mb4_0900_ai_ci NOT NULL DEFAULT '' COMMENT '错误信息',
   `created_at` timestamp NOT NULL DEFAULT CURRENT_TIMESTAMP COMMENT '创建时间',
   `updated_at` timestamp NOT NULL DEFAULT CURRENT_TIMESTAMP ON UPDATE CURRENT_TIMESTAMP COMMENT '更新时间',
+  `dir_path_l3` varchar(760) CHARACTER SET utf8mb4 COLLATE utf8mb4_0900_ai_ci GENERATED ALWAYS AS (left(substring_index(`path`,'/',4),760)) VIRTUAL COMMENT '三级目录，超过760个字符时截断',
   PRIMARY KEY (`id`),
-  KEY `idx-processed` (`is_processed`)
+  KEY `idx-processed` (`is_processed`,`id`),
+  KEY `idx-dirl3-processed` (`is_processed`,`dir_path_l3`)
 ) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4 COLLATE=utf8mb4_0900_ai_ci COMMENT='文件表';
\ No newline at end of file
@@ -1,9 +1,72 @@
 import os
+import json
+import queue
+import atexit
 import logging
-from logging.handlers import RotatingFileHandler
-from datetime import datetime
+from logging.handlers import RotatingFileHandler, QueueHandler, QueueListener
+from datetime import date
 from typing import Optional, Dict, Any
-from config import settings
+from config import get_settings
+
+settings = get_settings()
+
+# 每个app_name对应的后台日志线程，同名Logger重复创建时复用
+_listeners: Dict[str, QueueListener] = {}
+
+
+def _stop_listeners():
+    """进程退出前停止所有后台日志线程，确保队列中的日志全部写出"""
+    for listener in _listeners.values():
+        listener.stop()
+    _listeners.clear()
+
+
+atexit.register(_stop_listeners)
+
+
+def _dated_log_file(day: date) -> str:
+    """指定日期的日志文件路径：LOG_DIR/年/月/前缀_日.log"""
+    log_dir = os.path.join(settings.LOG_DIR, day.strftime("%Y/%m"))
+    os.makedirs(log_dir, exist_ok=True)
+    return os.path.join(log_dir, f"{settings.LOG_FILE_PREFIX}_{day.strftime('%d')}.log")
+
+
+class DailyRotatingFileHandler(RotatingFileHandler):
+    """
+    按日期追加写入的文件处理器
+    跨天时关闭旧文件并打开新一天的文件，切换时不重命名已有文件，多个进程共用同一日志文件也不会互相覆盖；
+    单个文件超过大小上限时仍按备份数量轮转
+    """
+
+    def __init__(self, max_bytes: int, backup_count: int):
+        self._day = date.today()
+        super().__init__(
+            _dated_log_file(self._day),
+            maxBytes=max_bytes,
+            backupCount=backup_count,
+            encoding="utf-8",
+            delay=True
+        )
+
+    def emit(self, record):
+        # 日期变化时切换到新一天的文件，下一次写入时再打开
+        today = date.today()
+        if today != self._day:
+            self._day = today
+            if self.stream:
+                self.stream.close()
+                self.stream = None
+            self.baseFilename = os.path.abspath(_dated_log_file(today))
+        super().emit(record)
+
+
+class ExtraDataFilter(logging.Filter):
+    """为未携带extra_data的日志记录补上空字符串，保证格式化不报错"""
+
+    def filter(self, record):
+        if not hasattr(record, "extra_data"):
+            record.extra_data = ""
+        return True
 
 
 class Logger:
@@ -13,21 +76,13 @@ class Logger:
         self.setup_logger()
 
     def setup_logger(self):
-        # 获取当前日期
-        now = datetime.now()
-        year_month = now.strftime("%Y/%m")
-        day = now.strftime("%d")
-
-        # 创建日志目录
-        log_dir = os.path.join(settings.LOG_DIR, year_month)
-        os.makedirs(log_dir, exist_ok=True)
-
-        # 设置日志文件路径
-        log_file = os.path.join(log_dir, f"{settings.LOG_FILE_PREFIX}_{day}.log")
-
         # 创建logger
         self.logger = logging.getLogger(self.app_name)
-        
+
+        # 同名logger已初始化过时直接复用，不再重建处理器和后台线程
+        if self.app_name in _listeners:
+            return
+
         # 设置日志级别
         log_level = getattr(logging, settings.LOG_LEVEL.upper())
         self.logger.setLevel(log_level)
@@ -36,12 +91,10 @@ class Logger:
         if self.logger.handlers:
             self.logger.handlers.clear()
 
-        # 创建文件处理器 (使用RotatingFileHandler代替FileHandler)
-        file_handler = RotatingFileHandler(
-            log_file, 
-            maxBytes=settings.LOG_FILE_MAX_BYTES,
-            backupCount=settings.LOG_FILE_BACKUP_COUNT,
-            encoding="utf-8"
+        # 创建文件处理器，按日期写入对应文件，跨天运行时自动切换到新一天的文件
+        file_handler = DailyRotatingFileHandler(
+            settings.LOG_FILE_MAX_BYTES,
+            settings.LOG_FILE_BACKUP_COUNT
         )
         file_handler.setLevel(log_level)
 
@@ -50,12 +103,6 @@ class Logger:
         console_handler.setLevel(log_level)
 
         # 添加自定义过滤器来处理extra_data
-        class ExtraDataFilter(logging.Filter):
-            def filter(self, record):
-                if not hasattr(record, "extra_data"):
-                    record.extra_data = ""
-                return True
-
         self.logger.addFilter(ExtraDataFilter())
 
         # 设置日志格式（在配置的格式基础上添加extra_data）
@@ -66,13 +113,21 @@ class Logger:
         file_handler.setFormatter(formatter)
         console_handler.setFormatter(formatter)
 
-        self.logger.addHandler(file_handler)
-        self.logger.addHandler(console_handler)
+        # 文件和控制台输出交给后台线程处理，调用方只需把日志放入队列
+        log_queue = queue.SimpleQueue()
+        listener = QueueListener(
+            log_queue, file_handler, console_handler, respect_handler_level=True
+        )
+        listener.start()
+        _listeners[self.app_name] = listener
+
+        self.logger.addHandler(QueueHandler(log_queue))
 
     def _log(self, level: int, message: str, extra: Optional[Dict[str, Any]] = None):
-        if extra is None:
-            extra = {}
-        extra_str = str(extra) if extra else ""
+        # 日志级别未启用时直接返回，跳过extra的序列化
+        if not self.logger.isEnabledFor(level):
+            return
+        extra_str = json.dumps(extra, ensure_ascii=False, default=str) if extra else ""
         self.logger.log(level, message, extra={"extra_data": extra_str})
 
     def debug(self, message: str, extra: Optional[Dict[str, Any]] = None):
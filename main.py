@@ -3,18 +3,21 @@ import json
 import asyncio
 import aiohttp
 import aiomysql
-from typing import List, Dict, Any
+from typing import List, Dict, Any, Set
 from datetime import datetime
 from dotenv import load_dotenv
-from config import settings
+from config import get_settings
 
 
 # 加载环境变量
 load_dotenv()
 
+settings = get_settings()
+
 # 配置
 API_BASE_URL = settings.API_BASE_URL
 API_TOKEN= settings.API_TOKEN
+LIST_CONCURRENCY = 16  # 同时请求目录列表的最大数量
 
 # MySQL配置
 MYSQL_CONFIG = {
@@ -23,7 +26,10 @@ MYSQL_CONFIG = {
     'user': settings.MYSQL_USER,
     'password': settings.MYSQL_PASSWORD,
     'db': settings.MYSQL_DATABASE,
-    'charset': 'utf8mb4'
+    'charset': 'utf8mb4',
+    'minsize': 1,  # 连接池最小连接数
+    'maxsize': LIST_CONCURRENCY,  # 连接池最大连接数，与并发遍历的目录数一致
+    'pool_recycle': 1800  # 连接回收时间(秒)，避免使用被服务端断开的连接
 }
 
 class AlistClient:
@@ -33,6 +39,8 @@ class AlistClient:
             "Authorization": API_TOKEN,
             "Content-Type": "application/json"
         }
+        # 限制同时进行的列表请求数量，避免并发遍历目录时压垮Alist
+        self.semaphore = asyncio.Semaphore(LIST_CONCURRENCY)
 
     async def list_files(self, path: str, page: int = 1, per_page: int = 100) -> Dict[str, Any]:
         """获取指定路径下的文件列表"""
@@ -45,8 +53,9 @@ class AlistClient:
             "refresh": False
         }
         
-        async with self.session.post(url, json=data, headers=self.headers) as response:
-            return await response.json()
+        async with self.semaphore:
+            async with self.session.post(url, json=data, headers=self.headers) as response:
+                return await response.json()
 
 class Database:
     def __init__(self):
@@ -62,36 +71,40 @@ class Database:
             self.pool.close()
             await self.pool.wait_closed()
 
-    async def file_exists(self, full_path: str) -> bool:
-        """检查文件是否已存在于数据库中"""
+    async def existing_paths(self, paths: List[str]) -> Set[str]:
+        """批量查询已存在于数据库中的文件路径，一次查询代替逐个检查"""
+        if not paths:
+            return set()
         async with self.pool.acquire() as conn:
             async with conn.cursor() as cur:
+                placeholders = ', '.join(['%s'] * len(paths))
                 await cur.execute(
-                    'SELECT 1 FROM files WHERE path = %s',
-                    (full_path,)
+                    f'SELECT path FROM files WHERE path IN ({placeholders})',
+                    paths
                 )
-                result = await cur.fetchone()
-                return bool(result)
-
-    async def save_file_info(self, file_info: Dict[str, Any], full_path: str):
-        """保存文件信息到数据库"""
+                return {row[0] for row in await cur.fetchall()}
+
+    async def save_files_info(self, files: List[Dict[str, Any]]):
+        """
+        批量保存文件信息到数据库
+        files: 文件信息列表，每项需包含name、path、size、sign
+        """
+        if not files:
+            return
         async with self.pool.acquire() as conn:
             async with conn.cursor() as cur:
-                # 获取文件名和目录路径
-                file_name = file_info['name']
-                
-                await cur.execute('''
+                # 语句需保持 INSERT ... VALUES (%s, ...) ON DUPLICATE ... 的形式（全部为占位符、不使用行别名），
+                # executemany才能合并为一条多行INSERT，否则会退化为逐行执行
+                await cur.executemany('''
                     INSERT INTO files (name, path, size, sign, is_processed)
-                    VALUES (%s, %s, %s, %s, 0) AS new_values
+                    VALUES (%s, %s, %s, %s, %s)
                     ON DUPLICATE KEY UPDATE
-                    size = new_values.size,
-                    sign = new_values.sign
-                ''', (
-                    file_name,
-                    full_path,
-                    file_info['size'],
-                    file_info['sign']
-                ))
+                    size = VALUES(size),
+                    sign = VALUES(sign)
+                ''', [
+                    (item['name'], item['path'], item['size'], item['sign'], 0)
+                    for item in files
+                ])
                 await conn.commit()
 
 async def process_directory(client: AlistClient, db: Database, path: str):
@@ -111,17 +124,32 @@ async def process_directory(client: AlistClient, db: Database, path: str):
             break
 
         # 处理当前页的所有文件和目录
+        sub_dirs = []
+        new_files = []
         for item in content:
             full_path = os.path.join(path, item['name']).replace('\\', '/')
             
             if item['is_dir']:
-                # 如果是目录，递归处理
-                await process_directory(client, db, full_path)
+                sub_dirs.append(full_path)
             else:
-                # 如果是文件，检查是否已处理过
-                if not await db.file_exists(full_path):
-                    await db.save_file_info(item, full_path)
-                    print(f"Added new file: {full_path}")
+                new_files.append({**item, 'path': full_path})
+
+        # 整页文件一次查询是否已处理过，只批量插入新文件
+        existing = await db.existing_paths([item['path'] for item in new_files])
+        new_files = [item for item in new_files if item['path'] not in existing]
+        await db.save_files_info(new_files)
+        for item in new_files:
+            print(f"Added new file: {item['path']}")
+
+        # 并发递归处理子目录，列表请求数量由客户端的信号量限制；
+        # 单个子目录出错只记录，不影响其他子目录继续遍历
+        results = await asyncio.gather(
+            *(process_directory(client, db, sub_dir) for sub_dir in sub_dirs),
+            return_exceptions=True
+        )
+        for sub_dir, result in zip(sub_dirs, results):
+            if isinstance(result, Exception):
+                print(f"Error processing path {sub_dir}: {result}")
 
         # 检查是否还有下一页
         total_pages = (data['total'] + 99) // 100  # 每页100项
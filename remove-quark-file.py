@@ -1,14 +1,18 @@
 import os
-import sys
+import argparse
 import asyncio
 import aiohttp
 import aiomysql
+import orjson
+import random
 import time
-from typing import Dict, Any, List, Optional
-from datetime import datetime
-from config import settings
+from collections import defaultdict
+from typing import Dict, Any, List, Optional, Set
+from config import get_settings
 from logger import Logger
 
+settings = get_settings()
+
 # 初始化日志
 logger = Logger("quark_remover").logger
 
@@ -20,14 +24,59 @@ MYSQL_CONFIG = {
     'password': settings.MYSQL_ROOT_PASSWORD,  # 使用root密码
     'db': settings.MYSQL_DATABASE,
     'charset': 'utf8mb4',
-    'autocommit': True  # 启用自动提交
+    'autocommit': True,  # 启用自动提交
+    'minsize': settings.DB_POOL_MIN,  # 连接池最小连接数
+    'maxsize': settings.DB_POOL_MAX,  # 连接池最大连接数
+    'pool_recycle': 1800,  # 连接回收时间(秒)，避免使用被服务端断开的连接
+    'connect_timeout': 5  # 建立连接超时(秒)
 }
 
 # 删除配置
 BATCH_SIZE = int(settings.BATCH_SIZE)  # 每次处理的文件数量
 SLEEP_TIME = int(settings.SLEEP_TIME)  # 每次循环后休眠时间(秒)
-MAX_DB_RETRIES = 3  # 数据库操作最大重试次数
-DB_RETRY_DELAY = 5  # 数据库重试延迟（秒）
+MAX_DB_RETRIES = 6  # 数据库操作最大重试次数
+MAX_HTTP_RETRIES = 3  # API请求遇到429/5xx时的最大重试次数
+BACKOFF_BASE = 0.5  # 重试退避基础时间(秒)，按2的指数增长
+MAX_BACKOFF = 60  # 重试退避时间上限(秒)
+REMOVE_CONCURRENCY = 16  # 同时进行的删除/创建目录请求数量
+DIR_PATH_L3_LENGTH = 760  # 三级目录生成列长度，(is_processed, dir_path_l3)索引需在3072字节以内
+
+# 熔断配置
+BREAKER_FAILURE_THRESHOLD = 5  # 连续失败多少次后熔断
+BREAKER_RESET_TIMEOUT = 30  # 熔断后的冷却时间(秒)
+BREAKER_HALF_OPEN_PROBES = 1  # 冷却结束后放行的探测调用数量
+
+# 熔断器状态
+CIRCUIT_CLOSED = "closed"  # 正常放行
+CIRCUIT_OPEN = "open"  # 熔断中，直接拒绝
+CIRCUIT_HALF_OPEN = "half_open"  # 放行少量探测调用
+
+# HTTP连接池配置
+HTTP_POOL_LIMIT = 64  # 连接池总连接数上限
+HTTP_POOL_LIMIT_PER_HOST = 64  # 单个主机的连接数上限
+HTTP_KEEPALIVE_TIMEOUT = 30  # keep-alive连接保持时间(秒)
+HTTP_DNS_CACHE_TTL = 300  # DNS缓存时间(秒)
+HTTP_TOTAL_TIMEOUT = 30  # 单个请求总超时(秒)
+HTTP_CONNECT_TIMEOUT = 5  # 建立连接超时(秒)
+
+# API请求头，作为会话默认请求头，每次请求无需再传
+API_HEADERS = {
+    "Authorization": settings.API_TOKEN,
+    "Content-Type": "application/json"
+}
+
+def backoff_delay(retries: int) -> float:
+    """计算全随机抖动的指数退避时间，避免大量协程同时重试"""
+    return random.uniform(0, min(MAX_BACKOFF, BACKOFF_BASE * (2 ** (retries - 1))))
+
+def parse_api_response(status: int, raw: bytes) -> Dict[str, Any]:
+    """解析API响应；返回的不是JSON时（如纯文本错误信息）转换为带状态码的错误结果"""
+    if raw[:1] in (b'{', b'['):
+        try:
+            return orjson.loads(raw)
+        except orjson.JSONDecodeError:
+            pass
+    return {"code": status, "message": raw[:256].decode('utf-8', 'replace')}
 
 class DatabaseError(Exception):
     """数据库操作异常"""
@@ -37,34 +86,83 @@ class RemoveError(Exception):
     """删除文件操作异常"""
     pass
 
+class CircuitOpenError(Exception):
+    """熔断器打开，调用被拒绝"""
+    pass
+
+class CircuitBreaker:
+    """
+    熔断器：连续失败达到阈值后进入打开状态，冷却期内直接拒绝调用；
+    冷却结束后放行少量探测调用，成功则恢复，失败则重新打开
+    """
+    def __init__(self, name: str):
+        self.name = name
+        self.state = CIRCUIT_CLOSED
+        self.failures = 0
+        self.opened_at = 0.0
+        self.probes = 0
+        self.lock = asyncio.Lock()
+
+    async def call(self, operation):
+        """通过熔断器执行异步操作"""
+        probing = False
+        async with self.lock:
+            if self.state == CIRCUIT_OPEN:
+                if time.monotonic() - self.opened_at < BREAKER_RESET_TIMEOUT:
+                    raise CircuitOpenError(f"{self.name}已熔断，暂停调用")
+                self.state = CIRCUIT_HALF_OPEN
+                self.probes = 0
+            if self.state == CIRCUIT_HALF_OPEN:
+                if self.probes >= BREAKER_HALF_OPEN_PROBES:
+                    raise CircuitOpenError(f"{self.name}正在探测恢复，暂停调用")
+                self.probes += 1
+                probing = True
+
+        try:
+            result = await operation()
+        except Exception:
+            async with self.lock:
+                self.failures += 1
+                if self.state == CIRCUIT_HALF_OPEN or self.failures >= BREAKER_FAILURE_THRESHOLD:
+                    if self.state != CIRCUIT_OPEN:
+                        logger.warning("熔断器打开", extra={"breaker": self.name, "failures": self.failures})
+                    self.state = CIRCUIT_OPEN
+                    self.opened_at = time.monotonic()
+            raise
+        finally:
+            # 探测调用结束（包括被取消）时归还名额，避免熔断器一直停留在半开状态
+            if probing:
+                self.probes = max(0, self.probes - 1)
+
+        async with self.lock:
+            if self.state != CIRCUIT_CLOSED:
+                logger.info("熔断器恢复", extra={"breaker": self.name})
+            self.state = CIRCUIT_CLOSED
+            self.failures = 0
+        return result
+
 class Database:
     def __init__(self):
         self.pool = None
+        self.breaker = CircuitBreaker("数据库")
+        # 串行化连接池重建，避免并发重试时各自创建连接池
+        self._pool_lock = asyncio.Lock()
 
     async def ensure_connected(self):
-        """确保数据库连接可用"""
-        if self.pool is None or self.pool._closed:
-            await self.init_db()
-        try:
-            async with self.pool.acquire() as conn:
-                async with conn.cursor() as cur:
-                    await cur.execute("SELECT 1")
-        except Exception as e:
-            logger.warning("数据库连接检查失败，尝试重新连接", extra={"error": str(e)})
-            await self.close()
-            await self.init_db()
+        """确保数据库连接池可用，只有连接池不存在或已关闭时才重建"""
+        if self.pool is not None and not self.pool._closed:
+            return
+        async with self._pool_lock:
+            if self.pool is None or self.pool._closed:
+                await self.init_db()
 
     async def init_db(self):
         """初始化数据库连接池"""
         retries = 0
         last_error = None
-        
+
         while retries < MAX_DB_RETRIES:
             try:
-                if self.pool:
-                    self.pool.close()
-                    await self.pool.wait_closed()
-                
                 self.pool = await aiomysql.create_pool(**MYSQL_CONFIG)
                 logger.info("数据库连接池初始化成功")
                 return
@@ -76,7 +174,7 @@ class Database:
                     "error": str(e)
                 })
                 if retries < MAX_DB_RETRIES:
-                    await asyncio.sleep(DB_RETRY_DELAY * retries)
+                    await asyncio.sleep(backoff_delay(retries))
         
         raise DatabaseError(f"数据库连接失败，已达到最大重试次数: {last_error}")
 
@@ -88,14 +186,25 @@ class Database:
             self.pool = None
 
     async def execute_with_retry(self, operation):
-        """使用重试机制执行数据库操作"""
+        """
+        使用重试机制执行数据库操作
+        operation: 接收一个数据库连接的异步函数，整个操作只从连接池获取一次连接
+        失败时只重试操作本身，失效的连接由aiomysql在归还时丢弃，不重建共享的连接池
+        """
         retries = 0
         last_error = None
         
+        async def _attempt():
+            await self.ensure_connected()
+            async with self.pool.acquire() as conn:
+                return await operation(conn)
+
         while retries < MAX_DB_RETRIES:
             try:
-                await self.ensure_connected()
-                return await operation()
+                return await self.breaker.call(_attempt)
+            except CircuitOpenError as e:
+                # 熔断期间不再重试，避免放大数据库压力
+                raise DatabaseError(str(e))
             except Exception as e:
                 last_error = e
                 retries += 1
@@ -104,77 +213,149 @@ class Database:
                     "error": str(e)
                 })
                 if retries < MAX_DB_RETRIES:
-                    await asyncio.sleep(DB_RETRY_DELAY * retries)
+                    await asyncio.sleep(backoff_delay(retries))
                     continue
                 raise DatabaseError(f"数据库操作失败，已达到最大重试次数: {last_error}")
 
-    async def get_unique_directories(self) -> List[str]:
-        """获取去重后的三级目录"""
-        async def _operation():
-            async with self.pool.acquire() as conn:
-                async with conn.cursor() as cur:
+    async def ensure_dir_path_column(self, create: bool = True) -> bool:
+        """
+        确保存在三级目录生成列及索引，使目录去重查询走索引而不是逐行计算
+        生成列为VIRTUAL，只修改表结构元数据；索引在线创建，不阻塞其他进程对files表的读写
+        生成列截断到DIR_PATH_L3_LENGTH个字符，超长路径不会导致其他进程写入files表失败
+        create: 为False时只检查不执行DDL（如--dry-run），无需ALTER权限
+        返回: 生成列和索引是否都已存在
+        """
+        async def _operation(conn):
+            async with conn.cursor() as cur:
+                await cur.execute("SHOW COLUMNS FROM files LIKE 'dir_path_l3'")
+                has_column = await cur.fetchone() is not None
+                await cur.execute("SHOW INDEX FROM files WHERE Key_name = 'idx-dirl3-processed'")
+                has_index = await cur.fetchone() is not None
+                if not create or (has_column and has_index):
+                    return has_column and has_index
+                if not has_column:
+                    logger.info("创建三级目录生成列", extra={"column": "dir_path_l3"})
+                    await cur.execute(f'''
+                        ALTER TABLE files 
+                        ADD COLUMN dir_path_l3 VARCHAR({DIR_PATH_L3_LENGTH}) 
+                            AS (LEFT(SUBSTRING_INDEX(path, '/', 4), {DIR_PATH_L3_LENGTH})) VIRTUAL COMMENT '三级目录', 
+                        ALGORITHM=INPLACE, LOCK=NONE
+                    ''')
+                if not has_index:
+                    logger.info("创建三级目录索引", extra={"index": "idx-dirl3-processed"})
                     await cur.execute('''
-                        SELECT DISTINCT 
-                            SUBSTRING_INDEX(
-                                SUBSTRING_INDEX(path, '/', 4),
-                                '/',
-                                4
-                            ) as dir_path
-                        FROM files 
-                        WHERE path LIKE '/material/%'
-                        AND is_processed = 1
+                        ALTER TABLE files 
+                        ADD INDEX `idx-dirl3-processed` (is_processed, dir_path_l3), 
+                        ALGORITHM=INPLACE, LOCK=NONE
                     ''')
-                    results = await cur.fetchall()
-                    return [result[0] for result in results if result[0]]
+                return True
         return await self.execute_with_retry(_operation)
 
+    async def get_unique_directories(self) -> List[str]:
+        """获取去重后的三级目录"""
+        return await self.execute_with_retry(self._query_unique_directories)
+
+    async def _query_unique_directories(self, conn) -> List[str]:
+        """从数据库查询去重后的三级目录"""
+        # 使用流式游标逐行读取，不在内存中保留完整结果集
+        async with conn.cursor(aiomysql.SSCursor) as cur:
+            # dir_path_l3 为 SUBSTRING_INDEX(path, '/', 4) 的生成列，可直接走索引去重
+            await cur.execute('''
+                SELECT DISTINCT dir_path_l3 
+                FROM files 
+                WHERE is_processed = 1 
+                AND dir_path_l3 LIKE '/material/%'
+            ''')
+            directories = []
+            async for row in cur:
+                if not row[0]:
+                    continue
+                if len(row[0]) >= DIR_PATH_L3_LENGTH:
+                    # 生成列已截断，不是完整的目录路径，跳过以免误删
+                    logger.warning("三级目录路径过长，跳过", extra={"dir_path": row[0]})
+                    continue
+                directories.append(row[0])
+            return directories
+
 class QuarkRemover:
     def __init__(self, session: aiohttp.ClientSession):
         self.session = session
-        self.headers = {
-            "Authorization": settings.API_TOKEN,
-            "Content-Type": "application/json"
-        }
+        self.breaker = CircuitBreaker("API")
+        self.remove_url = f"{settings.API_BASE_URL}/api/fs/remove"
+        self.mkdir_url = f"{settings.API_BASE_URL}/api/fs/mkdir"
+        # 本进程中已成功创建的目录，重复创建时直接返回
+        self._created: Set[str] = set()
 
-    async def remove_directory(self, dir_path: str) -> bool:
-        """删除指定目录"""
+    async def _post(self, url: str, data: Dict[str, Any]) -> Dict[str, Any]:
+        """发送API请求，经过熔断器，熔断期间直接失败"""
+        return await self.breaker.call(lambda: self._post_with_retry(url, data))
+
+    async def _post_with_retry(self, url: str, data: Dict[str, Any]) -> Dict[str, Any]:
+        """发送API请求，遇到限流(429)或服务端错误(5xx)时按指数退避重试"""
+        # 请求体只编码一次，重试时直接复用；Content-Type已在会话默认请求头中
+        body = orjson.dumps(data)
+        retries = 0
+        while True:
+            async with self.session.post(url, data=body) as response:
+                if response.status != 429 and response.status < 500:
+                    return parse_api_response(response.status, await response.read())
+                retries += 1
+                if retries > MAX_HTTP_RETRIES:
+                    raise RemoveError(f"请求失败，状态码: {response.status}")
+            logger.warning("API请求失败，稍后重试", extra={
+                "url": url,
+                "status": response.status,
+                "retry": f"{retries}/{MAX_HTTP_RETRIES}"
+            })
+            await asyncio.sleep(backoff_delay(retries))
+
+    async def remove_directories(self, parent: str, names: List[str]) -> bool:
+        """一次请求删除同一父目录下的多个子目录"""
         try:
-            url = f"{settings.API_BASE_URL}/api/fs/remove"
             data = {
-                "names": [""],  # 空字符串数组可以删除整个目录
-                "dir": dir_path
+                "names": names,
+                "dir": parent
             }
             
-            async with self.session.post(url, json=data, headers=self.headers) as response:
-                result = await response.json()
-                if result.get('code') != 200:
-                    raise RemoveError(f"删除失败: {result.get('message', '未知错误')}")
-                
-                logger.info("目录删除成功", extra={"dir_path": dir_path})
-                return True
+            result = await self._post(self.remove_url, data)
+            if result.get('code') != 200:
+                raise RemoveError(f"删除失败: {result.get('message', '未知错误')}")
+            
+            logger.info("目录删除成功", extra={"dir_path": parent, "count": len(names)})
+            # 已删除的目录及其子目录需要重新创建，一次遍历从已创建记录中移除：
+            # 位于parent下且第一级子目录名在本次删除列表中的路径即为被删除的目录或其子目录
+            prefix = parent.rstrip('/') + '/'
+            removed = set(names)
+            self._created = {
+                path for path in self._created
+                if not (path.startswith(prefix) and path[len(prefix):].split('/', 1)[0] in removed)
+            }
+            return True
 
         except Exception as e:
             logger.error("删除目录时出错", extra={
-                "dir_path": dir_path,
+                "dir_path": parent,
+                "names": names,
                 "error": str(e)
             })
             raise RemoveError(f"删除目录失败: {str(e)}")
 
     async def create_directory(self, path: str) -> bool:
-        """创建新目录"""
+        """创建新目录，本进程中已创建过的目录直接返回"""
+        if path in self._created:
+            return True
         try:
-            url = f"{settings.API_BASE_URL}/api/fs/mkdir"
             data = {
                 "path": path
             }
             
-            async with self.session.post(url, json=data, headers=self.headers) as response:
-                result = await response.json()
-                if result.get('code') != 200:
-                    raise RemoveError(f"创建目录失败: {result.get('message', '未知错误')}")
-                
-                logger.info("目录创建成功", extra={"path": path})
-                return True
+            result = await self._post(self.mkdir_url, data)
+            if result.get('code') != 200:
+                raise RemoveError(f"创建目录失败: {result.get('message', '未知错误')}")
+            
+            logger.info("目录创建成功", extra={"path": path})
+            self._created.add(path)
+            return True
 
         except Exception as e:
             logger.error("创建目录时出错", extra={
@@ -183,46 +364,104 @@ class QuarkRemover:
             })
             raise RemoveError(f"创建目录失败: {str(e)}")
 
-async def main():
+def group_by_parent(directories: List[str]) -> Dict[str, List[str]]:
+    """按父目录分组，返回 {父目录: [子目录名]}"""
+    groups: Dict[str, List[str]] = defaultdict(list)
+    for dir_path in directories:
+        parent, name = os.path.split(dir_path.rstrip('/'))
+        groups[parent].append(name)
+    return groups
+
+def leaf_directories(directories: List[str]) -> List[str]:
+    """去掉重复目录和其他目录的祖先目录，创建叶子目录时会一并创建其上级目录"""
+    unique = dict.fromkeys(d.rstrip('/') for d in directories)
+    ancestors = set()
+    for dir_path in unique:
+        parent = os.path.dirname(dir_path)
+        while parent not in ancestors and parent not in ('', '/'):
+            ancestors.add(parent)
+            parent = os.path.dirname(parent)
+    return [d for d in unique if d not in ancestors]
+
+async def remove_group(remover: QuarkRemover, semaphore: asyncio.Semaphore, parent: str, names: List[str]):
+    """删除同一父目录下的一组子目录，出错只记录日志"""
+    async with semaphore:
+        try:
+            await remover.remove_directories(parent, names)
+        except Exception as e:
+            logger.error("处理目录出错", extra={"dir_path": parent, "error": str(e)})
+
+async def create_one(remover: QuarkRemover, semaphore: asyncio.Semaphore, dir_path: str):
+    """创建单个目录，出错只记录日志"""
+    async with semaphore:
+        try:
+            await remover.create_directory(dir_path)
+            logger.info("目录创建完成", extra={"dir_path": dir_path})
+        except Exception as e:
+            logger.error("创建目录失败", extra={"dir_path": dir_path, "error": str(e)})
+
+def parse_args() -> argparse.Namespace:
+    """解析命令行参数"""
+    parser = argparse.ArgumentParser(description="删除并重新创建夸克网盘中已下载完成的三级目录")
+    parser.add_argument("--dry-run", action="store_true", help="只打印需要处理的目录，不执行删除和创建")
+    parser.add_argument("--limit", type=int, default=None, help="最多处理的目录数量")
+    parser.add_argument("--concurrency", type=int, default=REMOVE_CONCURRENCY, help="同时进行的删除/创建目录请求数量")
+    return parser.parse_args()
+
+async def main(args: argparse.Namespace):
     # 初始化数据库
     db = Database()
     await db.init_db()
-    
+
+    # 限制同时进行的API请求数量
+    concurrency = max(1, args.concurrency)
+    semaphore = asyncio.Semaphore(concurrency)
+
     try:
-        # 确保数据库连接可用
-        await db.ensure_connected()
-        
-        async with aiohttp.ClientSession() as session:
+        # 复用连接池、DNS缓存和keep-alive连接，连接数与并发请求数匹配
+        connector = aiohttp.TCPConnector(
+            limit=max(HTTP_POOL_LIMIT, concurrency),
+            limit_per_host=max(HTTP_POOL_LIMIT_PER_HOST, concurrency),
+            keepalive_timeout=HTTP_KEEPALIVE_TIMEOUT,
+            enable_cleanup_closed=True,
+            ttl_dns_cache=HTTP_DNS_CACHE_TTL
+        )
+        timeout = aiohttp.ClientTimeout(total=HTTP_TOTAL_TIMEOUT, connect=HTTP_CONNECT_TIMEOUT)
+        async with aiohttp.ClientSession(connector=connector, timeout=timeout, headers=API_HEADERS) as session:
             remover = QuarkRemover(session)
             
             # 获取未处理的目录
             try:
+                # 试运行不修改表结构，生成列或索引缺失时直接退出
+                if not await db.ensure_dir_path_column(create=not args.dry_run):
+                    logger.error("files表缺少dir_path_l3生成列或索引，请先不带--dry-run运行一次或执行files.sql中的定义")
+                    return
                 directories = await db.get_unique_directories()
                 if not directories:
                     logger.info("没有需要处理的目录")
                     return
+                if args.limit is not None:
+                    directories = directories[:args.limit]
 
                 logger.info("开始处理目录", extra={"count": len(directories)})
-                print(directories)
-                # 删除所有目录
+                if args.dry_run:
+                    for dir_path in directories:
+                        print(dir_path)
+                    return
+
+                # 同一父目录下的目录合并为一次删除请求，各父目录并发删除，全部删除完成后再重新创建
                 logger.info("开始删除目录...")
-                for dir_path in directories:
-                    try:
-                        success = await remover.remove_directory(dir_path)
-                    except Exception as e:
-                        logger.error("处理目录出错", extra={"dir_path": dir_path, "error": str(e)})
-                
+                await asyncio.gather(
+                    *(remove_group(remover, semaphore, parent, names)
+                      for parent, names in group_by_parent(directories).items())
+                )
                 logger.info("所有目录删除完成")
 
-                # 重新创建所有目录
+                # 并发重新创建所有目录，只需创建叶子目录
                 logger.info("开始创建目录...")
-                for dir_path in directories:
-                    try:
-                        await remover.create_directory(dir_path)
-                        logger.info("目录创建完成", extra={"dir_path": dir_path})
-                    except Exception as e:
-                        logger.error("创建目录失败", extra={"dir_path": dir_path, "error": str(e)})
-                
+                await asyncio.gather(
+                    *(create_one(remover, semaphore, dir_path) for dir_path in leaf_directories(directories))
+                )
                 logger.info("所有目录创建完成")
                     
             except DatabaseError as e:
@@ -236,4 +475,4 @@ async def main():
         await db.close()
 
 if __name__ == "__main__":
-    asyncio.run(main())
+    asyncio.run(main(parse_args()))
@@ -0,0 +1,95 @@
+import os
+import sys
+import asyncio
+import tempfile
+import unittest
+import importlib.util
+from unittest import mock
+
+# 导入脚本前补齐必填配置，日志写入临时目录
+os.environ.setdefault("DOWNLOAD_HOST", "http://127.0.0.1")
+os.environ.setdefault("GET_FILE_INFO_HOST", "http://127.0.0.1")
+os.environ.setdefault("MYSQL_DATABASE", "test")
+os.environ.setdefault("MYSQL_USER", "test")
+os.environ.setdefault("MYSQL_PASSWORD", "test")
+os.environ.setdefault("MYSQL_ROOT_PASSWORD", "test")
+os.environ.setdefault("LOG_DIR", tempfile.mkdtemp())
+
+ROOT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT_DIR)
+
+
+def load_remover():
+    """按文件路径导入remove-quark-file.py（文件名含连字符，无法直接import）"""
+    spec = importlib.util.spec_from_file_location(
+        "remove_quark_file", os.path.join(ROOT_DIR, "remove-quark-file.py")
+    )
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+remover = load_remover()
+
+
+async def succeed():
+    return "ok"
+
+
+async def fail():
+    raise RuntimeError("boom")
+
+
+class CircuitBreakerTest(unittest.IsolatedAsyncioTestCase):
+    async def test_closed_open_half_open_closed(self):
+        breaker = remover.CircuitBreaker("测试")
+        self.assertEqual(breaker.state, remover.CIRCUIT_CLOSED)
+
+        # 连续失败达到阈值后打开，调用方看到的是原始异常
+        for _ in range(remover.BREAKER_FAILURE_THRESHOLD):
+            with self.assertRaises(RuntimeError):
+                await breaker.call(fail)
+        self.assertEqual(breaker.state, remover.CIRCUIT_OPEN)
+
+        # 冷却期内直接拒绝
+        with self.assertRaises(remover.CircuitOpenError):
+            await breaker.call(succeed)
+
+        # 冷却结束后进入半开，探测成功则恢复
+        with mock.patch.object(remover, "BREAKER_RESET_TIMEOUT", 0):
+            self.assertEqual(await breaker.call(succeed), "ok")
+        self.assertEqual(breaker.state, remover.CIRCUIT_CLOSED)
+        self.assertEqual(breaker.failures, 0)
+
+    async def test_half_open_probe_failure_reopens(self):
+        breaker = remover.CircuitBreaker("测试")
+        for _ in range(remover.BREAKER_FAILURE_THRESHOLD):
+            with self.assertRaises(RuntimeError):
+                await breaker.call(fail)
+
+        with mock.patch.object(remover, "BREAKER_RESET_TIMEOUT", 0):
+            with self.assertRaises(RuntimeError):
+                await breaker.call(fail)
+        self.assertEqual(breaker.state, remover.CIRCUIT_OPEN)
+
+    async def test_cancelled_probe_releases_slot(self):
+        breaker = remover.CircuitBreaker("测试")
+        for _ in range(remover.BREAKER_FAILURE_THRESHOLD):
+            with self.assertRaises(RuntimeError):
+                await breaker.call(fail)
+
+        with mock.patch.object(remover, "BREAKER_RESET_TIMEOUT", 0):
+            probe = asyncio.create_task(breaker.call(lambda: asyncio.sleep(10)))
+            await asyncio.sleep(0)
+            self.assertEqual(breaker.state, remover.CIRCUIT_HALF_OPEN)
+            probe.cancel()
+            with self.assertRaises(asyncio.CancelledError):
+                await probe
+
+            # 被取消的探测归还名额，下一次调用可以继续探测
+            self.assertEqual(await breaker.call(succeed), "ok")
+        self.assertEqual(breaker.state, remover.CIRCUIT_CLOSED)
+
+
+if __name__ == "__main__":
+    unittest.main()